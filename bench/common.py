@@ -0,0 +1,89 @@
+"""bench/ 下各脚本共用的统计、语料、表格输出与基线对比。"""
+import json
+import os
+import random
+import statistics
+
+CN_WORDS = ["你好", "今天", "天气", "不错", "我们", "一起", "去", "公园", "散步", "语音", "合成", "测试", "欢迎",
+            "使用", "这个", "接口", "晚上", "吃饭", "朋友", "电脑", "学习", "日语", "发音", "非常", "有趣", "早上好"]
+EN_WORDS = ["hello", "world", "this", "is", "a", "voice", "synthesis", "test", "please", "listen", "to", "the",
+            "pronunciation", "thank", "you", "very", "much", "station", "phone", "video", "light", "table", "visit"]
+SPEAKER = 3
+
+
+def build_corpus(kind, n, seed=0):
+    # kind: cn / en / mixed；固定种子，保证每次生成相同语料
+    rng = random.Random(f"{kind}-{seed}")
+    out = []
+    for _ in range(n):
+        words = rng.choices(EN_WORDS if kind == "en" else CN_WORDS, k=rng.randint(4, 12))
+        if kind == "mixed": words = [rng.choice(EN_WORDS) if rng.random() < 0.3 else w for w in words]
+        if kind == "en":
+            out.append(" ".join(words).capitalize() + rng.choice([".", "!", "?"]))
+        else:
+            out.append("".join(w if w[0] >= "一" else f" {w} " for w in words).strip() + rng.choice(["。", "！", "？"]))
+    return out
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def summarize(case, samples, elapsed, **extra):
+    # samples 为每次调用的耗时（秒），elapsed 为整个场景的墙钟时间
+    return {
+        "case": case, "count": len(samples), "rps": len(samples) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(samples, 50) * 1e3, "p95_ms": percentile(samples, 95) * 1e3,
+        "p99_ms": percentile(samples, 99) * 1e3, "mean_ms": statistics.fmean(samples) * 1e3, **extra,
+    }
+
+
+def print_table(results, columns):
+    # columns: [(字段, 表头, 格式)]，第一列左对齐
+    (key, title, _), rest = columns[0], columns[1:]
+    width = max(len(title), *(len(str(r[key])) for r in results)) + 2
+    print(f"{title:<{width}}" + "".join(f"{t:>12}" for _, t, _ in rest))
+    for r in results:
+        print(f"{r[key]:<{width}}" + "".join(f"{format(r[k], f) if r.get(k) is not None else '-':>12}" for k, _, f in rest))
+
+
+def add_baseline_args(parser, default_path, tolerance=0.2):
+    parser.add_argument("--baseline", default=default_path, help="基线 JSON 文件")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果写为新基线")
+    parser.add_argument("--tolerance", type=float, default=tolerance, help="允许的退化比例")
+
+
+def compare(results, baseline, tolerance):
+    # 吞吐下降、p95 延迟或峰值内存上升超过 tolerance 记为回归
+    regressions = []
+    for r in results:
+        b = baseline.get(r["case"])
+        if not b: continue
+        if r["rps"] < b["rps"] * (1 - tolerance):
+            regressions.append(f"{r['case']}: req/s {b['rps']:.1f} -> {r['rps']:.1f}")
+        if r["p95_ms"] > b["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{r['case']}: p95 {b['p95_ms']:.3f}ms -> {r['p95_ms']:.3f}ms")
+        if r.get("peak_mb") and b.get("peak_mb") and r["peak_mb"] > b["peak_mb"] * (1 + tolerance):
+            regressions.append(f"{r['case']}: peak memory {b['peak_mb']:.1f}MB -> {r['peak_mb']:.1f}MB")
+    return regressions
+
+
+def finish(args, results):
+    # 保存或对比基线，返回进程退出码（有回归时为 1）
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({r["case"]: r for r in results}, f, ensure_ascii=False, indent=2)
+        print(f"\nbaseline saved to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"\nno baseline at {args.baseline}, run with --save-baseline to create one")
+        return 0
+    with open(args.baseline, encoding="utf-8") as f: baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    if not regressions:
+        print(f"\nno regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+        return 0
+    print(f"\nREGRESSIONS against {args.baseline} (tolerance {args.tolerance:.0%}):")
+    for line in regressions: print(f"  {line}")
+    return 1
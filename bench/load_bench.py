@@ -0,0 +1,162 @@
+"""端到端压测：在本地起桩引擎 (stub_engine.py) 和服务本体 (uvicorn 子进程)，对 /voices、/check_key、/tts 施压。
+
+用法: python bench/load_bench.py [--requests 500] [--concurrency 16] [--latency 0.05] [--audio-seconds 0]
+                                [--replay bench/tts_requests.jsonl] [--save-baseline]
+
+场景：voices、check_key、tts_miss（每次文本不同，必然调用引擎）、tts_hit（少量重复文本，走音频缓存），
+指定 --replay 时按 jsonl 里的 /tts 请求体循环回放。输出吞吐、p50/p95/p99 延迟、错误数与服务进程峰值 RSS。
+服务在临时目录中运行，数据库与缓存不会写进仓库；其余环境变量（如 TTS_ADMISSION_*）原样传给服务进程。
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from common import SPEAKER, add_baseline_args, build_corpus, finish, print_table, summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN_KEY = "xingshuo_admin"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_mb(pid):
+    # 仅 Linux：读 /proc 里的常驻内存，其他平台返回 None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"): return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+def spawn(args, workdir, name, env=None):
+    log = open(os.path.join(workdir, f"{name}.log"), "wb")
+    return subprocess.Popen([sys.executable, *args], cwd=workdir, env={**os.environ, **(env or {})},
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_ready(client, url, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None: raise RuntimeError(f"{url} exited with code {proc.returncode}")
+        try:
+            if (await client.get(url)).status_code < 500: return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+
+async def run_scenario(client, name, make_request, requests, concurrency, pid):
+    # make_request(i) -> (method, path, kwargs)；worker 共享一个计数器，总共发出 requests 个请求
+    samples, errors, received = [], {}, 0
+    counter = iter(range(requests))
+    peak = rss_mb(pid) or 0.0
+
+    async def worker():
+        nonlocal received
+        for i in counter:
+            method, path, kwargs = make_request(i)
+            t0 = time.perf_counter()
+            try:
+                r = await client.request(method, path, **kwargs)
+                status = r.status_code
+                received += len(r.content)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            samples.append(time.perf_counter() - t0)
+            if status != 200: errors[status] = errors.get(status, 0) + 1
+
+    async def sample_memory():
+        nonlocal peak
+        while True:
+            peak = max(peak, rss_mb(pid) or 0.0)
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.create_task(sample_memory())
+    t0 = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - t0
+    sampler.cancel()
+    return summarize(name, samples, elapsed, errors=sum(errors.values()), error_codes=errors,
+                     mb_per_s=received / elapsed / 2**20, peak_mb=peak or None)
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="load_bench_")
+    stub_port, app_port = free_port(), free_port()
+    stub = spawn([os.path.join(ROOT, "stub_engine.py"), "--port", str(stub_port), "--latency", str(args.latency),
+                  "--audio-seconds", str(args.audio_seconds)], workdir, "stub")
+    server = spawn(["-m", "uvicorn", "main:app", "--app-dir", ROOT, "--port", str(app_port), "--log-level", "warning"],
+                   workdir, "server", {"VOICEVOX_BASE_URL": f"http://127.0.0.1:{stub_port}"})
+    print(f"workdir {workdir} (stub.log / server.log)")
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{app_port}", timeout=60, limits=limits) as client:
+            await wait_ready(client, f"http://127.0.0.1:{stub_port}/version", stub)
+            await wait_ready(client, "/voices", server)
+            key = "load-bench"
+            r = await client.post("/admin/keys", json={"key": key, "credits": args.requests * 10},
+                                  headers={"X-Admin-Key": ADMIN_KEY})
+            r.raise_for_status()
+            headers = {"X-API-Key": key}
+            texts = build_corpus("mixed", 200)
+            for text in texts[:20]:  # 预热 tts_hit 用到的文本
+                await client.post("/tts", json={"text": text, "speaker": SPEAKER}, headers=headers)
+
+            scenarios = [
+                ("voices", lambda i: ("GET", "/voices", {})),
+                ("check_key", lambda i: ("GET", "/check_key", {"params": {"key": key}})),
+                ("tts_miss", lambda i: ("POST", "/tts", {"json": {"text": f"{texts[i % len(texts)]} {i}", "speaker": SPEAKER}, "headers": headers})),
+                ("tts_hit", lambda i: ("POST", "/tts", {"json": {"text": texts[i % 20], "speaker": SPEAKER}, "headers": headers})),
+            ]
+            if args.replay:
+                with open(args.replay, encoding="utf-8") as f: bodies = [json.loads(line) for line in f if line.strip()]
+                scenarios.append(("replay", lambda i: ("POST", "/tts", {"json": bodies[i % len(bodies)], "headers": headers})))
+            only = set(args.scenarios.split(",")) if args.scenarios else None
+            results = []
+            for name, make_request in scenarios:
+                if only and name not in only: continue
+                results.append(await run_scenario(client, name, make_request, args.requests, args.concurrency, server.pid))
+            return results
+    finally:
+        for proc in (server, stub):
+            proc.terminate()
+            try: proc.wait(10)
+            except subprocess.TimeoutExpired: proc.kill()
+
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500, help="每个场景的请求数")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.05, help="桩引擎每次调用的延迟（秒）")
+    parser.add_argument("--audio-seconds", type=float, default=0, help="桩引擎返回的音频长度，0 表示随文本长度变化")
+    parser.add_argument("--replay", help="/tts 请求体 jsonl，例如 bench/tts_requests.jsonl")
+    parser.add_argument("--scenarios", help="只跑指定场景，逗号分隔")
+    add_baseline_args(parser, os.path.join(ROOT, "bench", "load_baseline.json"))
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print_table(results, [("case", "scenario", ""), ("rps", "req/s", ".1f"), ("p50_ms", "p50 ms", ".1f"),
+                          ("p95_ms", "p95 ms", ".1f"), ("p99_ms", "p99 ms", ".1f"), ("errors", "errors", "d"),
+                          ("mb_per_s", "MB/s", ".2f"), ("peak_mb", "RSS MB", ".1f")])
+    for r in results:
+        if r["errors"]: print(f"{r['case']}: {r['error_codes']}")
+    sys.exit(finish(args, results))
+
+
+if __name__ == "__main__":
+    main_()
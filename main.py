@@ -1,19 +1,33 @@
 import os
 import re
 import json
+import asyncio
+import bisect
+import hashlib
+import math
 import logging
-import requests
+import shutil
+import threading
+import time
 import uuid
-from datetime import datetime
-from typing import Optional, List, Dict
+import zipfile
+import httpx
+from collections import OrderedDict, deque
+from functools import lru_cache
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional, List, Dict, Any
 from fastapi import FastAPI, HTTPException, Header, Depends, Request
-from fastapi.responses import Response, HTMLResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
 from pypinyin import pinyin, Style
-from sqlalchemy import Column, String, Integer, DateTime, create_engine
+from sqlalchemy import Column, String, Integer, DateTime, create_engine, event, update
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import sessionmaker
 
 # --- 汉化字典 ---
 CN_NAME_MAP = {
@@ -72,20 +86,447 @@ Base = declarative_base()
 engine = create_engine(DB_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+@event.listens_for(engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _):
+    # WAL：读不阻塞写，额度落库不再锁住 /check_key
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA busy_timeout=5000")
+    cur.close()
+
 class APIKeyRecord(Base):
     __tablename__ = "api_keys"
     key = Column(String, primary_key=True, index=True)
     credits = Column(Integer, default=50)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+class LedgerState(Base):
+    __tablename__ = "ledger_state"
+    id = Column(Integer, primary_key=True)
+    applied_seq = Column(Integer, default=0)
+
 Base.metadata.create_all(bind=engine)
 
 # --- 配置 ---
-VOICEVOX_URL = os.getenv("VOICEVOX_BASE_URL", "http://127.0.0.1:800").rstrip("/")
+# 多个引擎用逗号分隔，例如 http://127.0.0.1:50021,http://127.0.0.1:50022
+VOICEVOX_URLS = [u.strip().rstrip("/") for u in os.getenv("VOICEVOX_BASE_URL", "http://127.0.0.1:800").split(",") if u.strip()]
+VOICEVOX_MAX_CONCURRENCY = int(os.getenv("VOICEVOX_MAX_CONCURRENCY", "4"))
+VOICEVOX_POOL_SIZE = int(os.getenv("VOICEVOX_POOL_SIZE", "32"))
+VOICEVOX_CONNECT_TIMEOUT = float(os.getenv("VOICEVOX_CONNECT_TIMEOUT", "3"))
+VOICEVOX_QUERY_TIMEOUT = float(os.getenv("VOICEVOX_QUERY_TIMEOUT", "10"))
+VOICEVOX_SYNTHESIS_TIMEOUT = float(os.getenv("VOICEVOX_SYNTHESIS_TIMEOUT", "60"))
+VOICEVOX_RETRIES = int(os.getenv("VOICEVOX_RETRIES", "1"))
+VOICEVOX_FAILURE_THRESHOLD = int(os.getenv("VOICEVOX_FAILURE_THRESHOLD", "3"))
+VOICEVOX_COOLDOWN = float(os.getenv("VOICEVOX_COOLDOWN", "10"))
+VOICEVOX_HEALTH_INTERVAL = float(os.getenv("VOICEVOX_HEALTH_INTERVAL", "5"))
+ADMISSION_SLOTS = int(os.getenv("TTS_ADMISSION_SLOTS", str(VOICEVOX_MAX_CONCURRENCY * len(VOICEVOX_URLS))))
+ADMISSION_QUEUE_SIZE = int(os.getenv("TTS_ADMISSION_QUEUE", "256"))
+ADMISSION_PER_KEY_QUEUE = int(os.getenv("TTS_ADMISSION_PER_KEY_QUEUE", "32"))
+ADMISSION_DEADLINE = float(os.getenv("TTS_ADMISSION_DEADLINE", "10"))
+ADMISSION_BATCH_DEADLINE = float(os.getenv("TTS_ADMISSION_BATCH_DEADLINE", "60"))
+PRIORITY_CREDITS = int(os.getenv("TTS_PRIORITY_CREDITS", "1000"))
+TIMING_HEADER = os.getenv("TTS_TIMING_HEADER", "1") == "1"
+TRACE_LOG = os.getenv("TTS_TRACE_LOG", "0") == "1"
 ADMIN_KEY = "xingshuo_admin"
+CUSTOM_DICT_PATH = os.getenv("CUSTOM_DICT_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "custom_dict.json"))
+CONVERTER_MEMO_SIZE = int(os.getenv("CONVERTER_MEMO_SIZE", "16384"))
+CONVERT_INLINE_CHARS = int(os.getenv("TTS_CONVERT_INLINE_CHARS", "200"))
+STREAM_PARALLELISM = int(os.getenv("TTS_STREAM_PARALLELISM", "2"))
+BATCH_MAX_ITEMS = int(os.getenv("TTS_BATCH_MAX_ITEMS", "500"))
+BATCH_MAX_WORKERS = int(os.getenv("TTS_BATCH_MAX_WORKERS", "4"))
+CREDIT_FLUSH_INTERVAL = float(os.getenv("CREDIT_FLUSH_INTERVAL", "1.0"))
+CREDIT_JOURNAL_PATH = os.getenv("CREDIT_JOURNAL_PATH", "./credit_journal.log")
+VOICES_TTL = float(os.getenv("VOICES_TTL", "300"))
+VOICES_SNAPSHOT_PATH = os.getenv("VOICES_SNAPSHOT_PATH", "./voices_snapshot.json")
+KEY_CACHE_TTL = float(os.getenv("KEY_CACHE_TTL", "30"))
+KEY_CACHE_NEGATIVE_TTL = float(os.getenv("KEY_CACHE_NEGATIVE_TTL", "5"))
+KEY_CACHE_MAX_ENTRIES = int(os.getenv("KEY_CACHE_MAX_ENTRIES", "10000"))
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2048"))
+QUERY_EDIT_MAX = int(os.getenv("TTS_QUERY_EDIT_MAX", "10000"))
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+ENCODER_WORKERS = int(os.getenv("TTS_ENCODER_WORKERS", str(os.cpu_count() or 2)))
+AUDIO_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "./tts_cache")
+AUDIO_CACHE_MEM_BYTES = int(os.getenv("TTS_CACHE_MEM_BYTES", str(64 * 1024 * 1024)))
+AUDIO_CACHE_DISK_BYTES = int(os.getenv("TTS_CACHE_DISK_BYTES", str(1024 * 1024 * 1024)))
+
+# --- 监控指标 (Prometheus 文本格式) 与分阶段计时 ---
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Metrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [各桶计数..., sum, count]
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock: self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None: h = self._histograms[key] = [0] * (len(self.buckets) + 3)
+            h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs: return ""
+        escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+    def render(self, gauges=()):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, list(v)) for k, v in self._histograms.items())
+        lines, typed = [], set()
+        for (name, labels), value in counters:
+            if name not in typed: lines.append(f"# TYPE {name} counter"); typed.add(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), h in histograms:
+            if name not in typed: lines.append(f"# TYPE {name} histogram"); typed.add(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets, h):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {h[-1]}")
+            lines.append(f"{name}_sum{self._labels(labels)} {h[-2]}")
+            lines.append(f"{name}_count{self._labels(labels)} {h[-1]}")
+        for name, labels, value in gauges:
+            if name not in typed: lines.append(f"# TYPE {name} gauge"); typed.add(name)
+            lines.append(f"{name}{self._labels(sorted(labels.items()))} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(LATENCY_BUCKETS)
+_trace = ContextVar("tts_trace", default=None)
+
+trace_logger = logging.getLogger("tts.trace")
+if TRACE_LOG and not trace_logger.handlers:
+    # 根 logger 默认 WARNING，uvicorn 也只配置自己的 logger，trace 行需要单独的 handler 才能输出
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+    trace_logger.addHandler(_handler)
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+
+@contextmanager
+def stage(name):
+    # 记录某阶段耗时；请求内的子任务共享同一个 trace，并行阶段的耗时会累加
+    started = time.perf_counter()
+    try: yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe("tts_stage_seconds", elapsed, stage=name)
+        trace = _trace.get()
+        if trace is not None: trace[name] = trace.get(name, 0.0) + elapsed
+
+class MetricsMiddleware:
+    # 纯 ASGI 中间件：不缓冲响应体，对流式响应同样适用
+    def __init__(self, app): self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http": return await self.app(scope, receive, send)
+        trace, started = {}, time.perf_counter()
+        token = _trace.set(trace)
+        status, sent = 500, 0
+
+        async def send_wrapper(message):
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if TIMING_HEADER and trace:
+                    timing = ", ".join(f"{k};dur={v * 1000:.2f}" for k, v in trace.items())
+                    timing += f", total;dur={(time.perf_counter() - started) * 1000:.2f}"
+                    message = {**message, "headers": list(message.get("headers", [])) + [(b"server-timing", timing.encode("latin-1"))]}
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _trace.reset(token)
+            elapsed = time.perf_counter() - started
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            metrics.inc("http_requests_total", route=route, method=scope["method"], status=status)
+            if status >= 400: metrics.inc("http_errors_total", route=route, status=status)
+            metrics.observe("http_request_duration_seconds", elapsed, route=route)
+            metrics.inc("http_response_bytes_total", sent, route=route)
+            if TRACE_LOG and route.startswith("/tts"):
+                trace_logger.info("%s status=%d total=%.1fms bytes=%d %s", route, status, elapsed * 1000, sent,
+                             " ".join(f"{k}={v * 1000:.1f}ms" for k, v in trace.items()))
+
+# --- VOICEVOX 引擎客户端 (异步 + 连接池 + 并发上限) ---
+class EngineError(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code, self.detail = status_code, detail
+
+class EngineBackend:
+    # 单个引擎实例：并发上限、排队数、EWMA 延迟、熔断状态
+    def __init__(self, url, max_concurrency, failure_threshold, cooldown):
+        self.url = url
+        self.failure_threshold, self.cooldown = failure_threshold, cooldown
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.inflight = self.queued = 0
+        self.latency = None  # EWMA，秒
+        self.healthy = True
+        self.failures = 0  # 连续失败次数
+        self.open_until = 0.0
+        self.stats = {"requests": 0, "errors": 0, "probe_failures": 0}
+
+    def available(self, now):
+        return self.healthy and now >= self.open_until
+
+    def load_score(self):
+        # 预计等待时间：(排队 + 在途 + 1) × 平均延迟；没有样本时按 1 秒估计
+        return (self.queued + self.inflight + 1) * (self.latency if self.latency is not None else 1.0)
+
+    def record_success(self, elapsed):
+        self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+        self.failures, self.open_until = 0, 0.0
+
+    def record_failure(self):
+        self.stats["errors"] += 1
+        self.failures += 1
+        if self.failures >= self.failure_threshold: self.open_until = time.monotonic() + self.cooldown
+
+    def snapshot(self):
+        now = time.monotonic()
+        if self.open_until > now: circuit = "open"
+        elif self.failures >= self.failure_threshold: circuit = "half_open"
+        else: circuit = "closed"
+        return {"url": self.url, "healthy": self.healthy, "circuit": circuit, "inflight": self.inflight,
+                "queued": self.queued, "latency_ms": round(self.latency * 1000, 2) if self.latency is not None else None,
+                "consecutive_failures": self.failures, **self.stats}
+
+class EngineClient:
+    def __init__(self, base_urls, max_concurrency, pool_size, connect_timeout, query_timeout, synthesis_timeout,
+                 retries=1, failure_threshold=3, cooldown=10.0, health_interval=5.0):
+        self.backends = [EngineBackend(url, max_concurrency, failure_threshold, cooldown) for url in base_urls]
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.query_timeout, self.synthesis_timeout = query_timeout, synthesis_timeout
+        self.attempts = max(1, min(len(self.backends), retries + 1))
+        self.health_interval = health_interval
+        self._client = None
+
+    async def start(self):
+        size = self.pool_size * len(self.backends)
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=size, max_keepalive_connections=size),
+            timeout=httpx.Timeout(self.query_timeout, connect=self.connect_timeout),
+        )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _pick(self, tried):
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b not in tried and b.available(now)]
+        # 全部不可用时仍然尽力一试，而不是直接失败
+        if not candidates: candidates = [b for b in self.backends if b not in tried]
+        return min(candidates, key=EngineBackend.load_score)
 
-app = FastAPI()
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_headers=["*"], allow_methods=["*"])
+    async def _send(self, backend, method, path, timeout, limited, **kwargs):
+        waiting = True
+        backend.queued += 1
+        try:
+            async with (backend.slots if limited else nullcontext()):
+                backend.queued -= 1
+                waiting = False
+                backend.inflight += 1
+                backend.stats["requests"] += 1
+                started = time.monotonic()
+                try:
+                    r = await self._client.request(method, backend.url + path,
+                                                   timeout=httpx.Timeout(timeout, connect=self.connect_timeout), **kwargs)
+                finally:
+                    backend.inflight -= 1
+        except httpx.TimeoutException:
+            raise EngineError(504, f"VOICEVOX {path} timed out")
+        except httpx.HTTPError as e:
+            raise EngineError(502, f"VOICEVOX {path} unreachable: {e}")
+        finally:
+            if waiting: backend.queued -= 1
+        if r.status_code >= 500: raise EngineError(502, f"VOICEVOX {path} failed: HTTP {r.status_code}")
+        if r.status_code >= 400: raise EngineError(400, f"VOICEVOX {path} rejected the request: {r.text}")
+        backend.record_success(time.monotonic() - started)
+        return r
+
+    async def _request(self, method, path, timeout, limited=True, **kwargs):
+        tried = set()
+        for attempt in range(self.attempts):
+            backend = self._pick(tried)
+            try:
+                return await self._send(backend, method, path, timeout, limited, **kwargs)
+            except EngineError as e:
+                if e.status_code < 500: raise  # 请求本身有问题，换引擎也没用
+                backend.record_failure()
+                tried.add(backend)
+                if attempt + 1 == self.attempts: raise
+                logging.warning("VOICEVOX %s failed on %s, retrying on another engine: %s", path, backend.url, e.detail)
+
+    async def probe(self, backend):
+        try:
+            r = await self._client.get(backend.url + "/version", timeout=httpx.Timeout(self.connect_timeout))
+            ok = r.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        if not ok: backend.stats["probe_failures"] += 1
+        backend.healthy = ok
+
+    async def run_health_checks(self):
+        while True:
+            await asyncio.gather(*[self.probe(b) for b in self.backends])
+            await asyncio.sleep(self.health_interval)
+
+    def snapshot(self):
+        return [b.snapshot() for b in self.backends]
+
+    async def speakers(self):
+        return (await self._request("GET", "/speakers", self.query_timeout, limited=False)).json()
+
+    async def audio_query(self, text, speaker):
+        return (await self._request("POST", "/audio_query", self.query_timeout, params={"text": text, "speaker": speaker})).json()
+
+    async def synthesis(self, query, speaker):
+        return (await self._request("POST", "/synthesis", self.synthesis_timeout, params={"speaker": speaker}, json=query)).content
+
+# --- 准入调度 (有界队列 + 按 key 公平轮转 + 优先级 + 排队超时) ---
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BATCH = 0, 1, 2
+PRIORITY_NAMES = ("high", "normal", "batch")
+_admission = ContextVar("tts_admission", default=("", PRIORITY_NORMAL))  # (API key, 优先级)，子任务自动继承
+
+class AdmissionRejected(EngineError):
+    def __init__(self, status_code, detail, retry_after, key=None):
+        super().__init__(status_code, detail)
+        self.retry_after = retry_after
+        self.key = key  # 仅针对某个 key 的拒绝（排队数超限）时设置
+
+class AdmissionScheduler:
+    def __init__(self, slots, max_queue, per_key_queue, deadlines):
+        self.slots, self.max_queue, self.per_key_queue, self.deadlines = max(1, slots), max_queue, per_key_queue, deadlines
+        self.active = self.waiting = 0
+        self._queues = [OrderedDict() for _ in deadlines]  # 每个优先级：key -> 等待中的 future，key 之间轮转
+        self._per_key = {}
+        self._service_time = 1.0  # 占用槽位时长的 EWMA，用于估算 Retry-After
+        self.stats = {"admitted": 0, "queued": 0, "rejected_full": 0, "rejected_key": 0, "timeouts": 0}
+
+    def retry_after(self):
+        return max(1, math.ceil(self._service_time * (self.waiting + 1) / self.slots))
+
+    @asynccontextmanager
+    async def slot(self, key, priority):
+        await self._acquire(key, priority)
+        started = time.monotonic()
+        try: yield
+        finally:
+            self._service_time = 0.8 * self._service_time + 0.2 * (time.monotonic() - started)
+            self.active -= 1
+            self._dispatch()
+
+    async def _acquire(self, key, priority):
+        if self.active < self.slots and not self.waiting:
+            self.active += 1
+            self.stats["admitted"] += 1
+            metrics.observe("tts_admission_wait_seconds", 0.0, priority=PRIORITY_NAMES[priority])
+            return
+        if self.waiting >= self.max_queue:
+            self.stats["rejected_full"] += 1
+            raise AdmissionRejected(503, "Server busy, engine queue is full", self.retry_after())
+        if self._per_key.get(key, 0) >= self.per_key_queue:
+            self.stats["rejected_key"] += 1
+            raise AdmissionRejected(429, "Too many queued requests for this key", self.retry_after(), key)
+        fut = asyncio.get_running_loop().create_future()
+        self._queues[priority].setdefault(key, deque()).append(fut)
+        self.waiting += 1
+        self._per_key[key] = self._per_key.get(key, 0) + 1
+        self.stats["queued"] += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait({fut}, timeout=self.deadlines[priority])
+        except BaseException:
+            # 调用方被取消：已分到的槽位要还回去
+            if fut.done() and not fut.cancelled():
+                self.active -= 1
+                self._dispatch()
+            else:
+                self._remove(key, priority, fut)
+            raise
+        finally:
+            metrics.observe("tts_admission_wait_seconds", time.monotonic() - started, priority=PRIORITY_NAMES[priority])
+        if not fut.done():
+            self._remove(key, priority, fut)
+            self.stats["timeouts"] += 1
+            raise AdmissionRejected(503, "Timed out waiting for a free engine slot", self.retry_after())
+        self.stats["admitted"] += 1
+
+    def _remove(self, key, priority, fut):
+        fut.cancel()
+        queue = self._queues[priority].get(key)
+        if queue is None or fut not in queue: return
+        queue.remove(fut)
+        if not queue: del self._queues[priority][key]
+        self._dequeued(key)
+
+    def _dequeued(self, key):
+        self.waiting -= 1
+        self._per_key[key] -= 1
+        if not self._per_key[key]: del self._per_key[key]
+
+    def _dispatch(self):
+        for queues in self._queues:
+            while queues and self.active < self.slots:
+                key, queue = queues.popitem(last=False)
+                fut = queue.popleft()
+                if queue: queues[key] = queue  # 该 key 还有请求，排到本优先级队尾
+                self._dequeued(key)
+                if fut.done(): continue
+                self.active += 1
+                fut.set_result(None)
+
+    def snapshot(self):
+        return {**self.stats, "slots": self.slots, "active": self.active, "waiting": self.waiting,
+                "waiting_by_priority": {PRIORITY_NAMES[i]: sum(len(q) for q in queues.values()) for i, queues in enumerate(self._queues)},
+                "waiting_keys": len(self._per_key), "avg_service_seconds": round(self._service_time, 4),
+                "retry_after": self.retry_after()}
+
+scheduler = AdmissionScheduler(ADMISSION_SLOTS, ADMISSION_QUEUE_SIZE, ADMISSION_PER_KEY_QUEUE,
+                               (ADMISSION_DEADLINE, ADMISSION_DEADLINE, ADMISSION_BATCH_DEADLINE))
+
+voicevox = EngineClient(VOICEVOX_URLS, VOICEVOX_MAX_CONCURRENCY, VOICEVOX_POOL_SIZE,
+                        VOICEVOX_CONNECT_TIMEOUT, VOICEVOX_QUERY_TIMEOUT, VOICEVOX_SYNTHESIS_TIMEOUT,
+                        VOICEVOX_RETRIES, VOICEVOX_FAILURE_THRESHOLD, VOICEVOX_COOLDOWN, VOICEVOX_HEALTH_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app):
+    await run_in_threadpool(converter.warmup)
+    await run_in_threadpool(ledger.recover)
+    flusher = asyncio.create_task(ledger.run()) if ledger.buffered else None
+    await voicevox.start()
+    await run_in_threadpool(voice_catalog.load_snapshot)
+    voice_refresher = asyncio.create_task(voice_catalog.run())
+    health_checker = asyncio.create_task(voicevox.run_health_checks())
+    try: yield
+    finally:
+        health_checker.cancel()
+        voice_refresher.cancel()
+        if flusher is not None: flusher.cancel()
+        await voicevox.close()
+        await run_in_threadpool(ledger.close)
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_headers=["*"], allow_methods=["*"], expose_headers=["Server-Timing"])
 
 # --- 核心：伪日语转换逻辑 (包含 PINYIN_TO_KANA) ---
 # (为了节省篇幅，这里使用了之前定义的 PINYIN_TO_KANA)
@@ -118,44 +559,686 @@ PINYIN_TO_KANA = {
     "zha": "ジャー", "zhai": "ジャイ", "zhan": "ジャン", "zhang": "ジャン", "zhao": "ジャオ", "zhe": "ジャ", "zhei": "ジェイ", "zhen": "ジェン", "zheng": "ジェン", "zhi": "ジー", "zhong": "ジョン", "zhou": "ジョウ", "zhu": "ジュー", "zhua": "ジュア", "zhuai": "ジュアイ", "zhuan": "ジュアン", "zhuang": "ジュアン", "zhui": "ジュイ", "zhun": "ジュン", "zhuo": "ジュオ"
 }
 
+ENGLISH_RULES = (("th", "s"), ("ph", "f"), ("v", "b"), ("l", "r"), ("tion", "shon"), ("si", "shi"), ("tu", "chu"), ("ti", "chi"))
+_TOKEN_RE = re.compile(r'[\u4e00-\u9fff]+|[a-zA-Z0-9]+|[^a-zA-Z0-9\u4e00-\u9fff]+')
+_LATIN_RE = re.compile(r'[a-zA-Z]')
+_TRIE_END = None
+
+class KanaTrie:
+    def __init__(self, mapping=None):
+        self._root = {}
+        self._size = 0
+        for key, value in (mapping or {}).items(): self.insert(key, value)
+
+    def __len__(self): return self._size
+
+    def insert(self, key, value):
+        node = self._root
+        for ch in key: node = node.setdefault(ch, {})
+        if _TRIE_END not in node: self._size += 1
+        node[_TRIE_END] = value
+
+    def longest_match(self, text, start=0):
+        # 返回 (结束位置, 替换值)，没有命中时返回 None
+        node, best = self._root, None
+        for i in range(start, len(text)):
+            node = node.get(text[i])
+            if node is None: break
+            if _TRIE_END in node: best = (i + 1, node[_TRIE_END])
+        return best
+
+def load_custom_dict(path):
+    try:
+        with open(path, encoding="utf-8") as f: return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning("custom dict %s ignored: %s", path, e)
+        return {}
+
 class PseudoConverter:
+    def __init__(self, overrides=None, memo_size=CONVERTER_MEMO_SIZE):
+        # custom_dict.json 的词条：中文按最长匹配切分，英文按整词匹配（不区分大小写）
+        self.overrides = KanaTrie({k.lower(): v for k, v in (overrides or {}).items()})
+        self.convert_token = lru_cache(maxsize=memo_size)(self._convert_token)
+
     def is_chinese(self, char): return '\u4e00' <= char <= '\u9fff'
-    def process_chinese(self, text):
+
+    def _pinyin_to_kana(self, text):
         py_list = pinyin(text, style=Style.NORMAL, errors='default')
         return "".join([PINYIN_TO_KANA.get(p[0].lower().replace("ü", "v"), p[0]) for p in py_list])
+
+    def process_chinese(self, text):
+        if not self.overrides: return self._pinyin_to_kana(text)
+        out, run_start, i = [], 0, 0
+        while i < len(text):
+            m = self.overrides.longest_match(text, i)
+            if m is None:
+                i += 1
+                continue
+            if run_start < i: out.append(self._pinyin_to_kana(text[run_start:i]))
+            out.append(m[1])
+            i = run_start = m[0]
+        if run_start < len(text): out.append(self._pinyin_to_kana(text[run_start:]))
+        return "".join(out)
+
     def process_english(self, text):
         text = text.lower()
-        replacements = [("th", "s"), ("ph", "f"), ("v", "b"), ("l", "r"), ("tion", "shon"), ("si", "shi"), ("tu", "chu"), ("ti", "chi")]
-        for old, new in replacements: text = text.replace(old, new)
+        m = self.overrides.longest_match(text)
+        if m is not None and m[0] == len(text): return m[1]
+        for old, new in ENGLISH_RULES: text = text.replace(old, new)
         if text[-1] not in "aeiou": text += "o" if text[-1] in "td" else "u"
         return text
+
+    def _convert_token(self, t):
+        if self.is_chinese(t[0]): return self.process_chinese(t)
+        return self.process_english(t) if _LATIN_RE.match(t) else t
+
     def convert(self, text):
-        tokens = re.findall(r'[\u4e00-\u9fff]+|[a-zA-Z0-9]+|[^a-zA-Z0-9\u4e00-\u9fff]+', text)
-        return "".join([self.process_chinese(t) if self.is_chinese(t[0]) else (self.process_english(t) if re.match(r'[a-zA-Z]+', t) else t) for t in tokens])
+        return "".join([self.convert_token(t) for t in _TOKEN_RE.findall(text)])
 
-converter = PseudoConverter()
+    def warmup(self):
+        # 提前加载 pypinyin 词典与分词器，避免首个请求承担冷启动开销
+        self.convert("预热中文拼音转换 warm up")
 
-def get_db():
-    db = SessionLocal()
-    try: yield db
-    finally: db.close()
+converter = PseudoConverter(load_custom_dict(CUSTOM_DICT_PATH))
 
-# --- 接口模型 ---
-class TTSRequest(BaseModel):
-    text: str
-    speaker: int
-    mode: Optional[str] = "pseudo_jp"
-    speedScale: Optional[float] = 1.1
-    pitchScale: Optional[float] = 0.0
-    intonationScale: Optional[float] = 1.0
+# --- API Key 缓存 (TTL + 写穿透) ---
+_MISS = object()
 
-# --- API ---
+class KeyCache:
+    # key -> (可用额度, 加载时间)；额度为 None 表示 key 不存在（负缓存）
+    def __init__(self, ttl, negative_ttl, max_entries):
+        self.ttl, self.negative_ttl, self.max_entries = ttl, negative_ttl, max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._age_sum = self._age_max = 0.0
+        self.stats = {"hits": 0, "negative_hits": 0, "misses": 0, "expired": 0,
+                      "invalidations": 0, "evictions": 0, "refresh_corrections": 0}
 
-@app.get("/voices")
-def get_voices():
-    r = requests.get(f"{VOICEVOX_URL}/speakers").json()
+    def _fresh(self, entry, now):
+        return now - entry[1] < (self.ttl if entry[0] is not None else self.negative_ttl)
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not self._fresh(entry, now):
+                self.stats["misses"] += 1
+                if entry is not None: self.stats["expired"] += 1
+                return _MISS
+            self._entries.move_to_end(key)
+            age = now - entry[1]
+            self._age_sum += age
+            self._age_max = max(self._age_max, age)
+            self.stats["negative_hits" if entry[0] is None else "hits"] += 1
+            return entry[0]
+
+    def put(self, key, value, refresh=False):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            # 过期重载时值发生变化，说明缓存期间库里被改过，用于衡量 TTL 内的实际陈旧程度
+            if refresh and old is not None and old[0] != value: self.stats["refresh_corrections"] += 1
+            self._entries[key] = (value, time.monotonic())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def adjust(self, key, delta, minimum=None):
+        # True: 已调整；False: key 不存在或额度不足；None: 未缓存或已过期，需要重新加载
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not self._fresh(entry, time.monotonic()): return None
+            if entry[0] is None or (minimum is not None and entry[0] < minimum): return False
+            self._entries[key] = (entry[0] + delta, entry[1])
+            return True
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None: self.stats["invalidations"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["negative_hits"] + self.stats["misses"]
+            served = lookups - self.stats["misses"]
+            return {**self.stats, "entries": len(self._entries), "ttl": self.ttl,
+                    "hit_rate": served / lookups if lookups else 0.0,
+                    "avg_staleness": self._age_sum / served if served else 0.0,
+                    "max_staleness": self._age_max}
+
+key_cache = KeyCache(KEY_CACHE_TTL, KEY_CACHE_NEGATIVE_TTL, KEY_CACHE_MAX_ENTRIES)
+
+# --- 额度账本 (内存原子扣减 + 定期批量落库 + journal 崩溃恢复) ---
+class CreditLedger:
+    # flush_interval <= 0 时退化为直写模式：每次扣减都是一条带条件的 UPDATE，适合多进程部署
+    def __init__(self, session_factory, journal_path, flush_interval, cache):
+        self.session_factory, self.journal_path, self.flush_interval = session_factory, journal_path, flush_interval
+        self.buffered = flush_interval > 0
+        self.cache = cache  # 只用于鉴权查询（余额展示、拦截无效 key），TTL 可以为 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._balances = {}  # 缓冲模式下的权威余额：key -> 库内额度 + 未落库增量
+        self._pending = {}  # key -> 未落库增量
+        self._seq = 0
+        self._journal = None
+        self.stats = {"reserved": 0, "refunded": 0, "rejected": 0, "flushes": 0, "flush_errors": 0}
+
+    def recover(self):
+        # 把上次进程退出前未落库的 journal 条目补写入库
+        if not self.buffered: return
+        entries = []
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding="utf-8") as f:
+                for line in f:
+                    try: entries.append(json.loads(line))
+                    except ValueError: break  # 崩溃时写了一半的尾行
+        db = self.session_factory()
+        try:
+            state = db.get(LedgerState, 1)
+            applied = state.applied_seq if state else 0
+            deltas, last_seq = {}, applied
+            for seq, key, delta in entries:
+                if seq > applied: deltas[key] = deltas.get(key, 0) + delta
+                last_seq = max(last_seq, seq)
+            self._apply(db, deltas, last_seq)
+            db.commit()
+            self._seq = last_seq
+        finally:
+            db.close()
+        if deltas: logging.info("credit ledger replayed %d journal entries", len(deltas))
+        self._rewrite_journal()
+
+    def _apply(self, db, deltas, seq):
+        for key, delta in deltas.items():
+            if delta: db.execute(update(APIKeyRecord).where(APIKeyRecord.key == key).values(credits=APIKeyRecord.credits + delta))
+        state = db.get(LedgerState, 1)
+        if state is None: db.add(LedgerState(id=1, applied_seq=seq))
+        else: state.applied_seq = seq
+
+    def _rewrite_journal(self):
+        # 只保留尚未落库的增量，journal 不会无限增长
+        if not self.buffered: return
+        with self._lock:
+            tmp = self.journal_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for key, delta in self._pending.items():
+                    self._seq += 1
+                    f.write(json.dumps([self._seq, key, delta], ensure_ascii=False) + "\n")
+            if self._journal is not None: self._journal.close()
+            os.replace(tmp, self.journal_path)
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def _record(self, key, delta):
+        # 调用方持有 self._lock
+        self._pending[key] = self._pending.get(key, 0) + delta
+        self._seq += 1
+        if self._journal is not None:
+            self._journal.write(json.dumps([self._seq, key, delta], ensure_ascii=False) + "\n")
+            self._journal.flush()
+
+    def _load(self, key):
+        db = self.session_factory()
+        try:
+            record = db.get(APIKeyRecord, key)
+            return record.credits if record else None
+        finally:
+            db.close()
+
+    def _load_balance(self, key):
+        # 与 flush 互斥：否则可能读到刚落库的增量后又叠加一次 pending
+        with self._flush_lock:
+            credits = self._load(key)
+            with self._lock:
+                if credits is None: value = None
+                elif self.buffered: value = self._balances.setdefault(key, credits + self._pending.get(key, 0))
+                else: value = credits
+                self.cache.put(key, value, refresh=True)
+        return value
+
+    def _cached_balance(self, key):
+        value = self.cache.get(key)
+        if value is not _MISS: return value
+        with self._lock:
+            if key in self._balances:
+                value = self._balances[key]
+                self.cache.put(key, value, refresh=True)
+                return value
+        return self._load_balance(key)
+
+    def balance(self, key):
+        return self._cached_balance(key)
+
+    def reserve(self, key, amount=1):
+        # 成功时返回扣减后的余额（调用方据此定优先级，不必再查一次），失败返回 None
+        if not self.buffered: return self._reserve_direct(key, amount)
+        with self._lock: known = key in self._balances
+        # 缓存只用来快速拒绝已知不存在的 key；扣减以 _balances 为准
+        if not known and (self.cache.get(key) is None or self._load_balance(key) is None):
+            with self._lock: self.stats["rejected"] += 1
+            return None
+        with self._lock:
+            balance = self._balances.get(key)
+            if balance is None or balance < amount:
+                self.stats["rejected"] += 1
+                return None
+            self._balances[key] = balance - amount
+            self.cache.adjust(key, -amount)
+            self._record(key, -amount)
+            self.stats["reserved"] += amount
+        return balance - amount
+
+    def _reserve_direct(self, key, amount):
+        cached = self._cached_balance(key)
+        # 缓存里已知 key 不存在或额度不足时不必再碰数据库
+        ok = False
+        if cached is not None and cached >= amount:
+            db = self.session_factory()
+            try:
+                res = db.execute(update(APIKeyRecord)
+                                 .where(APIKeyRecord.key == key, APIKeyRecord.credits >= amount)
+                                 .values(credits=APIKeyRecord.credits - amount))
+                db.commit()
+            finally:
+                db.close()
+            ok = res.rowcount == 1
+            if ok: self.cache.adjust(key, -amount)
+            else:
+                # 重新加载，让不存在/额度不足的 key 进入缓存，后续请求直接拒绝
+                self.cache.invalidate(key)
+                self._cached_balance(key)
+        with self._lock:
+            if ok: self.stats["reserved"] += amount
+            else: self.stats["rejected"] += 1
+        # 直连模式下余额取自扣减前的缓存值，只是估计，够用来定优先级
+        return cached - amount if ok else None
+
+    def refund(self, key, amount=1):
+        if amount <= 0: return
+        if not self.buffered:
+            db = self.session_factory()
+            try:
+                db.execute(update(APIKeyRecord).where(APIKeyRecord.key == key).values(credits=APIKeyRecord.credits + amount))
+                db.commit()
+            finally:
+                db.close()
+            self.cache.adjust(key, amount)
+        else:
+            with self._lock:
+                if key in self._balances: self._balances[key] += amount
+                self.cache.adjust(key, amount)
+                self._record(key, amount)
+        with self._lock: self.stats["refunded"] += amount
+
+    # 管理操作：直接写库并同步更新缓存（写穿透），与 flush 互斥保证 "库内额度 + pending" 一致
+    def create_key(self, key, credits):
+        with self._flush_lock:
+            db = self.session_factory()
+            try:
+                if db.get(APIKeyRecord, key) is not None: return False
+                db.add(APIKeyRecord(key=key, credits=credits))
+                db.commit()
+            finally:
+                db.close()
+            with self._lock:
+                self._pending.pop(key, None)
+                if self.buffered: self._balances[key] = credits
+                self.cache.put(key, credits)
+        return True
+
+    def add_credits(self, key, amount):
+        with self._flush_lock:
+            db = self.session_factory()
+            try:
+                res = db.execute(update(APIKeyRecord).where(APIKeyRecord.key == key).values(credits=APIKeyRecord.credits + amount))
+                db.commit()
+                if res.rowcount != 1: return None
+                credits = db.get(APIKeyRecord, key).credits
+            finally:
+                db.close()
+            with self._lock:
+                value = credits + self._pending.get(key, 0)
+                if self.buffered: self._balances[key] = value
+                self.cache.put(key, value)
+        return value
+
+    def delete_key(self, key):
+        with self._flush_lock:
+            db = self.session_factory()
+            try:
+                deleted = db.query(APIKeyRecord).filter(APIKeyRecord.key == key).delete()
+                db.commit()
+            finally:
+                db.close()
+            with self._lock:
+                self._pending.pop(key, None)
+                self._balances.pop(key, None)
+                self.cache.put(key, None)
+            self._rewrite_journal()
+        return deleted == 1
+
+    def flush(self):
+        if not self.buffered: return
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending: return
+                pending, self._pending = self._pending, {}
+                upto = self._seq
+            db = self.session_factory()
+            try:
+                try:
+                    with stage("credit_flush"):
+                        self._apply(db, pending, upto)
+                        db.commit()
+                except Exception:
+                    db.rollback()
+                    with self._lock:
+                        for key, delta in pending.items(): self._pending[key] = self._pending.get(key, 0) + delta
+                        self.stats["flush_errors"] += 1
+                    logging.exception("credit ledger flush failed")
+                    return
+                # 增量已提交：之后的失败绝不能把 pending 放回去，否则下次 flush 会重复扣费
+                try:
+                    fresh = dict(db.query(APIKeyRecord.key, APIKeyRecord.credits).filter(APIKeyRecord.key.in_(list(pending))).all())
+                except Exception:
+                    logging.exception("credit ledger re-read after flush failed")
+                    fresh = None  # _balances 本身仍然正确，只是没能同步外部改动
+            finally:
+                db.close()
+            with self._lock:
+                # 以库内最新值为准（可能在别处被改过），再叠加刷盘期间的新增量
+                for key in (pending if fresh is not None else ()):
+                    if key not in fresh:
+                        self._balances.pop(key, None)
+                        continue
+                    value = fresh[key] + self._pending.get(key, 0)
+                    if key in self._balances: self._balances[key] = value
+                    self.cache.put(key, value, refresh=True)
+                self.stats["flushes"] += 1
+            self._rewrite_journal()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await run_in_threadpool(self.flush)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, "mode": "buffered" if self.buffered else "direct", "pending_keys": len(self._pending),
+                    "tracked_keys": len(self._balances)}
+
+ledger = CreditLedger(SessionLocal, CREDIT_JOURNAL_PATH, CREDIT_FLUSH_INTERVAL, key_cache)
+
+# --- 合成音频缓存 (内存 LRU + 磁盘分片文件) ---
+class AudioCache:
+    def __init__(self, directory, mem_bytes, disk_bytes):
+        self.directory, self.mem_bytes, self.disk_bytes = directory, mem_bytes, disk_bytes
+        self._mem = OrderedDict()
+        self._mem_size = 0
+        self._disk = OrderedDict()  # digest -> size，按最近使用排序
+        self._disk_size = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "mem_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "disk_evictions": 0}
+        if directory and disk_bytes > 0:
+            os.makedirs(directory, exist_ok=True)
+            self._load_index()
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".bin")
+
+    def _load_index(self):
+        # 重启后按 mtime 恢复磁盘层的 LRU 顺序
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".bin"): continue
+                st = os.stat(os.path.join(root, name))
+                entries.append((st.st_mtime, name[:-4], st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_size += size
+
+    def get(self, key):
+        with self._lock:
+            data = self._mem.get(key)
+            if data is not None:
+                self._mem.move_to_end(key)
+                self.stats["hits"] += 1
+                self.stats["mem_hits"] += 1
+                return data
+            on_disk = key in self._disk
+        data = self._read_disk(key) if on_disk else None
+        with self._lock:
+            if data is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self.stats["disk_hits"] += 1
+            if key in self._disk: self._disk.move_to_end(key)
+            self._put_mem(key, data)
+        return data
+
+    def _admit(self, key, data):
+        # 放入内存层，返回是否还需要写磁盘
+        with self._lock:
+            self._put_mem(key, data)
+            return bool(self.directory) and self.disk_bytes > 0 and key not in self._disk and len(data) <= self.disk_bytes
+
+    # 事件循环里用下面两个：内存层直接处理，磁盘读写放到线程池，大文件不会卡住其他请求
+    async def aget(self, key):
+        with self._lock: on_disk = key not in self._mem and key in self._disk
+        return await run_in_threadpool(self.get, key) if on_disk else self.get(key)
+
+    async def aput(self, key, data):
+        if self._admit(key, data): await run_in_threadpool(self._write_disk, key, data)
+
+    def _put_mem(self, key, data):
+        if len(data) > self.mem_bytes: return
+        old = self._mem.pop(key, None)
+        if old is not None: self._mem_size -= len(old)
+        self._mem[key] = data
+        self._mem_size += len(data)
+        while self._mem_size > self.mem_bytes:
+            _, evicted = self._mem.popitem(last=False)
+            self._mem_size -= len(evicted)
+            self.stats["evictions"] += 1
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f: data = f.read()
+            os.utime(path)
+            return data
+        except (OSError, ValueError):
+            with self._lock:
+                size = self._disk.pop(key, None)
+                if size is not None: self._disk_size -= size
+            return None
+
+    def _write_disk(self, key, data):
+        path = self._path(key)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, "wb") as f: f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.warning("audio cache write failed: %s", e)
+            return
+        stale = []
+        with self._lock:
+            if key not in self._disk:
+                self._disk[key] = len(data)
+                self._disk_size += len(data)
+            while self._disk_size > self.disk_bytes and len(self._disk) > 1:
+                old_key, size = self._disk.popitem(last=False)
+                self._disk_size -= size
+                self.stats["disk_evictions"] += 1
+                stale.append(old_key)
+        for old_key in stale:
+            try: os.remove(self._path(old_key))
+            except OSError: pass
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.stats, "mem_entries": len(self._mem), "mem_bytes": self._mem_size,
+                    "disk_entries": len(self._disk), "disk_bytes": self._disk_size}
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MEM_BYTES, AUDIO_CACHE_DISK_BYTES)
+
+# --- 音频编码 (ffmpeg 子进程，边合成边编码) ---
+# format -> (Content-Type, ffmpeg 输出参数)；wav 直接返回引擎输出
+AUDIO_FORMATS = {
+    "wav": ("audio/wav", None),
+    "opus": ("audio/ogg", ["-c:a", "libopus", "-b:a", "32k", "-f", "ogg"]),
+    "mp3": ("audio/mpeg", ["-c:a", "libmp3lame", "-b:a", "64k", "-f", "mp3"]),
+    "flac": ("audio/flac", ["-c:a", "flac", "-f", "flac"]),
+}
+FORMAT_ALIASES = {"ogg": "opus"}
+ACCEPT_FORMATS = {"audio/wav": "wav", "audio/wave": "wav", "audio/x-wav": "wav", "audio/ogg": "opus", "audio/opus": "opus",
+                  "audio/mpeg": "mp3", "audio/mp3": "mp3", "audio/flac": "flac", "audio/x-flac": "flac"}
+SAMPLE_RATES = (8000, 12000, 16000, 24000)
+
+def wav_params(fmt):
+    # (声道数, 采样率, 位深)
+    return int.from_bytes(fmt[2:4], "little"), int.from_bytes(fmt[4:8], "little"), int.from_bytes(fmt[14:16], "little")
+
+class AudioEncoder:
+    def __init__(self, ffmpeg_bin, workers):
+        self.ffmpeg_bin = shutil.which(ffmpeg_bin)
+        self._slots = asyncio.Semaphore(max(1, workers))
+        self.stats = {"encodes": 0, "errors": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def supports(self, fmt):
+        return fmt == "wav" or self.ffmpeg_bin is not None
+
+    async def encode(self, fmt, wav_fmt, pcm_chunks):
+        # pcm_chunks: 异步产出 16bit PCM；边写入 ffmpeg 边读出编码结果
+        channels, rate, bits = wav_params(wav_fmt)
+        if bits != 16: raise EngineError(502, f"Unsupported PCM bit depth {bits}")
+        async with self._slots:
+            proc = await asyncio.create_subprocess_exec(
+                self.ffmpeg_bin, "-hide_banner", "-loglevel", "error", "-f", "s16le", "-ar", str(rate), "-ac", str(channels),
+                "-i", "pipe:0", *AUDIO_FORMATS[fmt][1], "pipe:1",
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+            async def feed():
+                try:
+                    async for pcm in pcm_chunks:
+                        self.stats["bytes_in"] += len(pcm)
+                        proc.stdin.write(pcm)
+                        await proc.stdin.drain()
+                finally:
+                    proc.stdin.close()
+
+            feeder = asyncio.ensure_future(feed())
+            try:
+                while True:
+                    data = await proc.stdout.read(64 * 1024)
+                    if not data: break
+                    self.stats["bytes_out"] += len(data)
+                    yield data
+                try: await feeder
+                except (BrokenPipeError, ConnectionResetError): pass  # ffmpeg 提前退出，下面按退出码报错
+                if await proc.wait() != 0:
+                    err = (await proc.stderr.read()).decode("utf-8", "replace").strip()
+                    raise EngineError(500, f"{fmt} encoding failed: {err}")
+                self.stats["encodes"] += 1
+            except BaseException:
+                self.stats["errors"] += 1
+                raise
+            finally:
+                # 等 feeder 真正退出，否则它可能还在上游生成器里，调用方随后 aclose 会报 "already running"
+                feeder.cancel()
+                await asyncio.wait({feeder})
+                if not feeder.cancelled(): feeder.exception()
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+
+encoder = AudioEncoder(FFMPEG_BIN, ENCODER_WORKERS)
+
+def negotiate_format(requested, accept):
+    # 显式 format 优先；否则按 Accept 的 q 值挑选可用格式，都不匹配时退回 wav
+    if requested:
+        fmt = FORMAT_ALIASES.get(requested.lower(), requested.lower())
+        if fmt not in AUDIO_FORMATS: raise HTTPException(status_code=400, detail=f"Unsupported format {requested}")
+        if not encoder.supports(fmt): raise HTTPException(status_code=406, detail=f"{fmt} encoding is not available on this server")
+        return fmt
+    ranked = []
+    for i, part in enumerate((accept or "").split(",")):
+        media_type, *params = [p.strip() for p in part.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try: q = float(param[2:])
+                except ValueError: q = 0.0
+        fmt = ACCEPT_FORMATS.get(media_type.lower())
+        if fmt and q > 0 and encoder.supports(fmt): ranked.append((-q, i, fmt))
+    return min(ranked)[2] if ranked else "wav"
+
+# --- AudioQuery 缓存 (与语速/音高/抑扬等合成参数无关) ---
+class QueryCache:
+    # (转换后文本, 音色) -> (revision, AudioQuery)；revision 为空表示引擎原样结果
+    # 用户编辑的 query 按 API key 隔离、单独存放，不会被引擎结果挤出；revision 为 (key, 内容) 的哈希
+    def __init__(self, max_entries, max_edits):
+        self.max_entries, self.max_edits = max_entries, max_edits
+        self._entries = OrderedDict()
+        self._edits = OrderedDict()  # (API key, 转换后文本, 音色) -> (revision, AudioQuery)
+        self.stats = {"hits": 0, "edit_hits": 0, "misses": 0, "evictions": 0, "edits": 0, "edit_evictions": 0}
+
+    def get(self, text, speaker, key=None):
+        # 传入 key 时优先返回该 key 自己编辑过的版本
+        entry = self._edits.get((key, text, speaker)) if key is not None else None
+        if entry is not None:
+            self._edits.move_to_end((key, text, speaker))
+            self.stats["edit_hits"] += 1
+            return entry
+        entry = self._entries.get((text, speaker))
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end((text, speaker))
+        self.stats["hits"] += 1
+        return entry
+
+    def put(self, text, speaker, query):
+        self._entries[(text, speaker)] = entry = ("", query)
+        self._entries.move_to_end((text, speaker))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+        return entry
+
+    def edit(self, key, text, speaker, query):
+        entry = (AudioCache.make_key(key, query)[:16], query)
+        self._edits[(key, text, speaker)] = entry
+        self._edits.move_to_end((key, text, speaker))
+        self.stats["edits"] += 1
+        while len(self._edits) > self.max_edits:
+            self._edits.popitem(last=False)
+            self.stats["edit_evictions"] += 1
+        return entry
+
+    def snapshot(self):
+        return {**self.stats, "entries": len(self._entries), "edited_entries": len(self._edits)}
+
+query_cache = QueryCache(QUERY_CACHE_SIZE, QUERY_EDIT_MAX)
+
+# --- 音色目录 (内存缓存 + 后台刷新 + 引擎故障时沿用旧数据) ---
+def build_voice_catalogue(speakers):
     grouped = {}
-    for char in r:
+    for char in speakers:
         raw_name = char["name"]
         display_name = CN_NAME_MAP.get(raw_name, raw_name)
         styles = []
@@ -171,23 +1254,582 @@ def get_voices():
         }
     return list(grouped.values())
 
+class VoiceCatalog:
+    def __init__(self, client, ttl, snapshot_path):
+        self.client, self.ttl, self.snapshot_path = client, ttl, snapshot_path
+        self.voices = None
+        self.body, self.etag, self.last_modified = b"", None, None
+        self.style_ids = frozenset()
+        self.fetched_at = None  # time.monotonic()；None 表示从未成功拉取过（可能只有磁盘快照）
+        self._refreshing = None
+        self._attempted_at = None
+        self.stats = {"refreshes": 0, "refresh_errors": 0, "served_stale": 0, "not_modified": 0}
+
+    def _install(self, voices, last_modified=None):
+        body = json.dumps(voices, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if etag != self.etag:
+            self.voices, self.body, self.etag = voices, body, etag
+            self.last_modified = last_modified or datetime.now(timezone.utc).replace(microsecond=0)
+            self.style_ids = frozenset(s["id"] for v in voices for s in v["styles"])
+
+    def load_snapshot(self):
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f: snap = json.load(f)
+            self._install(snap["voices"], datetime.fromtimestamp(snap["last_modified"], timezone.utc))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning("voice snapshot %s ignored: %s", self.snapshot_path, e)
+
+    def _save_snapshot(self):
+        tmp = f"{self.snapshot_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"voices": self.voices, "last_modified": self.last_modified.timestamp()}, f, ensure_ascii=False)
+            os.replace(tmp, self.snapshot_path)
+        except OSError as e:
+            logging.warning("voice snapshot write failed: %s", e)
+
+    async def _refresh(self):
+        try:
+            voices = build_voice_catalogue(await self.client.speakers())
+        except (EngineError, ValueError, KeyError, TypeError) as e:
+            self.stats["refresh_errors"] += 1
+            logging.warning("voice catalogue refresh failed, keeping previous copy: %s", e)
+            return
+        old_etag = self.etag
+        self._install(voices)
+        self.fetched_at = time.monotonic()
+        self.stats["refreshes"] += 1
+        if self.etag != old_etag: await run_in_threadpool(self._save_snapshot)
+
+    def refresh(self):
+        # 同一时刻只有一个刷新任务，并发请求共用它
+        if self._refreshing is None or self._refreshing.done():
+            self._attempted_at = time.monotonic()
+            self._refreshing = asyncio.ensure_future(self._refresh())
+        return self._refreshing
+
+    def is_stale(self):
+        return self.fetched_at is None or time.monotonic() - self.fetched_at >= self.ttl
+
+    async def get(self):
+        if self.voices is None:
+            # shield：某个调用方断开不能取消其他人共用的加载任务
+            await asyncio.shield(self.refresh())
+            if self.voices is None: raise EngineError(503, "Voice catalogue unavailable")
+        elif self.is_stale():
+            self.stats["served_stale"] += 1
+            # 引擎故障期间限制重试频率，避免每个请求都去敲一次 /speakers
+            if self._attempted_at is None or time.monotonic() - self._attempted_at >= min(self.ttl, 10): self.refresh()
+        return self
+
+    def has_style(self, style_id):
+        # 目录尚未加载时不拦截，交给引擎判断
+        return not self.style_ids or style_id in self.style_ids
+
+    async def run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.ttl if self.voices is not None and not self.is_stale() else min(self.ttl, 10))
+
+voice_catalog = VoiceCatalog(voicevox, VOICES_TTL, VOICES_SNAPSHOT_PATH)
+
+# --- 接口模型 ---
+class TTSRequest(BaseModel):
+    text: str
+    speaker: int
+    mode: Optional[str] = "pseudo_jp"
+    speedScale: Optional[float] = 1.1
+    pitchScale: Optional[float] = 0.0
+    intonationScale: Optional[float] = 1.0
+    stream: Optional[bool] = False
+    format: Optional[str] = None  # wav | opus (ogg) | mp3 | flac；不填时按 Accept 协商
+    sampleRate: Optional[int] = None
+
+    @field_validator("sampleRate")
+    @classmethod
+    def check_sample_rate(cls, v):
+        # 放在模型上校验，/tts 与 /tts/batch 的每一项都会经过
+        if v and v not in SAMPLE_RATES: raise ValueError(f"sampleRate must be one of {list(SAMPLE_RATES)}")
+        return v
+
+class AudioQueryEdit(BaseModel):
+    text: str
+    speaker: int
+    mode: Optional[str] = "pseudo_jp"
+    query: Dict[str, Any]
+
+class KeyCreateRequest(BaseModel):
+    key: Optional[str] = None
+    credits: Optional[int] = 50
+
+class CreditAdjustRequest(BaseModel):
+    amount: int
+
+class TTSBatchRequest(BaseModel):
+    items: List[TTSRequest]
+    format: Optional[str] = "zip"  # zip | multipart
+    max_workers: Optional[int] = None
+
+# --- 合成流水线 ---
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[。！？；!?;．\n])|(?<=\.)(?!\d)')
+_SPEAKABLE_RE = re.compile(r'\w')
+
+def split_sentences(text):
+    # 按中/日/英句末标点切分；不含可读字符的碎片并入上一句
+    chunks = []
+    for piece in _SENTENCE_SPLIT_RE.split(text):
+        if not piece.strip(): continue
+        if chunks and not _SPEAKABLE_RE.search(piece): chunks[-1] += piece
+        else: chunks.append(piece)
+    return chunks or [text]
+
+def split_wav(data):
+    # 返回 (fmt 块内容, PCM 数据)
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE": raise EngineError(502, "VOICEVOX returned non-WAV audio")
+    pos, fmt = 12, None
+    while pos + 8 <= len(data):
+        chunk_id, size = data[pos:pos + 4], int.from_bytes(data[pos + 4:pos + 8], "little")
+        body = data[pos + 8:pos + 8 + size]
+        if chunk_id == b"fmt ": fmt = body
+        elif chunk_id == b"data" and fmt is not None: return fmt, body
+        pos += 8 + size + (size & 1)
+    raise EngineError(502, "VOICEVOX returned a WAV without fmt/data chunks")
+
+def wav_header(fmt, data_size=0xFFFFFFFF):
+    # 流式输出时长度未知，RIFF/data 长度按惯例填 0xFFFFFFFF
+    riff_size = min(0xFFFFFFFF, 4 + 8 + len(fmt) + 8 + data_size)
+    return (b"RIFF" + riff_size.to_bytes(4, "little") + b"WAVE"
+            + b"fmt " + len(fmt).to_bytes(4, "little") + fmt
+            + b"data" + data_size.to_bytes(4, "little"))
+
+class SingleFlight:
+    # 相同 key 的并发调用共享同一个任务；任务用 shield 保护，某个调用方断开不会取消其他人的结果
+    def __init__(self):
+        self._inflight = {}
+        self.stats = {"leaders": 0, "coalesced": 0}
+
+    def _done(self, key, task):
+        if self._inflight.get(key) is task: del self._inflight[key]
+        if not task.cancelled(): task.exception()  # 所有调用方都已离开时避免 "exception never retrieved"
+
+    async def do(self, key, fn):
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda t: self._done(key, t))
+            self.stats["leaders"] += 1
+        else:
+            self.stats["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    def snapshot(self):
+        return {**self.stats, "inflight": len(self._inflight)}
+
+query_flight, synthesis_flight = SingleFlight(), SingleFlight()
+
+def convert_text(text, mode):
+    if mode != "pseudo_jp": return text
+    metrics.inc("tts_chars_converted_total", len(text))
+    with stage("convert"): return converter.convert(text)
+
+async def aconvert_text(text, mode):
+    # 长文本的拼音转换放到线程池，避免阻塞事件循环；短文本直接转换，省去线程切换
+    if mode == "pseudo_jp" and len(text) > CONVERT_INLINE_CHARS: return await run_in_threadpool(convert_text, text, mode)
+    return convert_text(text, mode)
+
+def audio_cache_key(text, req, revision=""):
+    # 可选维度只在非默认时加入，已有缓存条目的键保持不变
+    parts = [text, req.speaker, req.mode, req.speedScale, req.pitchScale, req.intonationScale]
+    if revision: parts.append(revision)
+    if req.sampleRate: parts.append(f"sr={req.sampleRate}")
+    return AudioCache.make_key(*parts)
+
+async def get_audio_query(text, speaker):
+    entry = query_cache.get(text, speaker)
+    if entry is None: entry = await query_flight.do((text, speaker), lambda: _fetch_audio_query(text, speaker))
+    return entry
+
+async def _fetch_audio_query(text, speaker):
+    with stage("audio_query"): q = await voicevox.audio_query(text, speaker)
+    return query_cache.put(text, speaker, q)
+
+async def synthesize(text, req):
+    if not voice_catalog.has_style(req.speaker): raise EngineError(400, f"Unknown speaker id {req.speaker}")
+    entry = query_cache.get(text, req.speaker, _admission.get()[0])
+    cache_key = audio_cache_key(text, req, entry[0] if entry else "")
+    audio = await audio_cache.aget(cache_key)
+    # 同一时刻的相同请求（如广播消息）只合成一次，所有调用方拿到同一份音频。
+    # 只在同一优先级内合并：交互请求若跟随批量请求，会在批量档排队并沿用批量的期限
+    if audio is None:
+        miss = lambda: _synthesize_miss(text, req, entry, cache_key)
+        flight_key = (cache_key, _admission.get()[1])
+        try:
+            audio = await synthesis_flight.do(flight_key, miss)
+        except AdmissionRejected as e:
+            # 合并进来的请求继承的是领头请求的准入结果；别的 key 排队超限不应连累本请求，用自己的 key 再试一次
+            if e.key is None or e.key == _admission.get()[0]: raise
+            audio = await synthesis_flight.do(flight_key, miss)
+    return audio
+
+async def _synthesize_miss(text, req, entry, cache_key):
+    # 只有真正要调用引擎时才排队；缓存命中和被合并的请求不占槽位
+    async with scheduler.slot(*_admission.get()):
+        # 复用缓存的 AudioQuery，只替换本次请求的语速/音高/抑扬
+        _, q = entry or await get_audio_query(text, req.speaker)
+        q = {**q, "speedScale": req.speedScale, "pitchScale": req.pitchScale, "intonationScale": req.intonationScale}
+        if req.sampleRate: q["outputSamplingRate"] = req.sampleRate  # 降采样交给引擎完成
+        with stage("synthesis"): audio = await voicevox.synthesis(q, req.speaker)
+    await audio_cache.aput(cache_key, audio)
+    return audio
+
+async def refund_credits(key, amount=1):
+    # shield：客户端断开导致请求被取消时，退款仍会完成
+    if amount > 0: await asyncio.shield(run_in_threadpool(ledger.refund, key, amount))
+
+def request_priority(balance):
+    # 额度充足的 key 享有更高优先级；balance 为 ledger.reserve 返回的扣减后余额
+    return PRIORITY_HIGH if balance >= PRIORITY_CREDITS else PRIORITY_NORMAL
+
+async def iter_synthesized(chunks, req, parallelism):
+    # 滑动窗口：最多 parallelism 段同时合成，按原顺序产出
+    pending, it = deque(), iter(chunks)
+    try:
+        for chunk in it:
+            pending.append(asyncio.ensure_future(synthesize(chunk, req)))
+            if len(pending) >= parallelism: break
+        while pending:
+            audio = await pending.popleft()
+            nxt = next(it, None)
+            if nxt is not None: pending.append(asyncio.ensure_future(synthesize(nxt, req)))
+            yield audio
+    finally:
+        for task in pending:
+            task.cancel()
+            # 已经失败的后续段落不会再有人 await，取走异常避免 "exception never retrieved"
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+# --- API ---
+
+@app.exception_handler(EngineError)
+async def engine_error_handler(request: Request, exc: EngineError):
+    headers = {"Retry-After": str(exc.retry_after)} if isinstance(exc, AdmissionRejected) else None
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail}, headers=headers)
+
+@app.get("/voices")
+async def get_voices(request: Request):
+    catalog = await voice_catalog.get()
+    headers = {"ETag": catalog.etag, "Last-Modified": format_datetime(catalog.last_modified, usegmt=True), "Cache-Control": "no-cache"}
+    if_none_match, if_modified_since = request.headers.get("if-none-match"), request.headers.get("if-modified-since")
+    if if_none_match is not None:
+        not_modified = if_none_match.strip() == "*" or catalog.etag in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    elif if_modified_since is not None:
+        try: not_modified = parsedate_to_datetime(if_modified_since) >= catalog.last_modified
+        except (TypeError, ValueError): not_modified = False
+    else:
+        not_modified = False
+    if not_modified:
+        catalog.stats["not_modified"] += 1
+        return Response(status_code=304, headers=headers)
+    return Response(content=catalog.body, media_type="application/json", headers=headers)
+
 @app.get("/check_key")
-def check_key(key: str, db: Session = Depends(get_db)):
-    record = db.query(APIKeyRecord).filter(APIKeyRecord.key == key).first()
-    if not record: raise HTTPException(status_code=404, detail="Key not found")
-    return {"credits": record.credits}
+def check_key(key: str):
+    credits = ledger.balance(key)
+    if credits is None: raise HTTPException(status_code=404, detail="Key not found")
+    return {"credits": credits}
 
 @app.post("/tts")
-def tts(req: TTSRequest, x_api_key: str = Header(...), db: Session = Depends(get_db)):
-    record = db.query(APIKeyRecord).filter(APIKeyRecord.key == x_api_key).first()
-    if not record or record.credits <= 0: raise HTTPException(status_code=401, detail="Invalid key or no credits")
-    target_text = converter.convert(req.text) if req.mode == "pseudo_jp" else req.text
-    q = requests.post(f"{VOICEVOX_URL}/audio_query", params={"text": target_text, "speaker": req.speaker}).json()
-    q["speedScale"], q["pitchScale"], q["intonationScale"] = req.speedScale, req.pitchScale, req.intonationScale
-    audio = requests.post(f"{VOICEVOX_URL}/synthesis", params={"speaker": req.speaker}, json=q).content
-    record.credits -= 1
-    db.commit()
-    return Response(content=audio, media_type="audio/wav")
+async def tts(req: TTSRequest, x_api_key: str = Header(...), accept: Optional[str] = Header(None)):
+    fmt = negotiate_format(req.format, accept)
+    # 先预扣额度，引擎失败时退还
+    with stage("auth"): balance = await run_in_threadpool(ledger.reserve, x_api_key)
+    if balance is None: raise HTTPException(status_code=401, detail="Invalid key or no credits")
+    try:
+        _admission.set((x_api_key, request_priority(balance)))
+        target_text = await aconvert_text(req.text, req.mode)
+        if req.stream: return await stream_tts(target_text, req, fmt, x_api_key)
+        audio = await synthesize(target_text, req)
+        if fmt == "wav": return Response(content=audio, media_type="audio/wav", headers={"Vary": "Accept"})
+        return await encoded_response(audio, fmt, x_api_key)
+    except BaseException:
+        await refund_credits(x_api_key)
+        raise
+
+async def encoded_response(audio, fmt, api_key):
+    # 编码结果按 (WAV 内容哈希, 格式) 缓存；未命中时边编码边返回，完整编码后再入缓存
+    media_type = AUDIO_FORMATS[fmt][0]
+    key = AudioCache.make_key("encoded", fmt, hashlib.sha256(audio).hexdigest())
+    cached = await audio_cache.aget(key)
+    if cached is not None: return Response(content=cached, media_type=media_type, headers={"Vary": "Accept"})
+    wav_fmt, pcm = split_wav(audio)
+
+    async def single():
+        yield pcm
+
+    # 拿到第一块编码输出再返回 200：ffmpeg 启动或编码失败仍以 HTTP 错误返回，额度由调用方退还
+    chunks = encoder.encode(fmt, wav_fmt, single())
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = b""
+    except BaseException:
+        await chunks.aclose()
+        raise
+
+    async def body():
+        parts = [first]
+        try:
+            yield first
+            async for data in chunks:
+                parts.append(data)
+                yield data
+        except EngineError as e:
+            logging.warning("tts encode aborted: %s", e.detail)
+            await refund_credits(api_key)
+            return
+        finally:
+            await chunks.aclose()
+        await audio_cache.aput(key, b"".join(parts))
+    return StreamingResponse(body(), media_type=media_type, headers={"Vary": "Accept"})
+
+async def stream_tts(target_text, req, out_format, api_key):
+    chunks = iter_synthesized(split_sentences(target_text), req, max(1, STREAM_PARALLELISM))
+    # 首句在返回 200 之前合成，引擎错误仍能以正常的 HTTP 错误返回
+    try:
+        fmt, pcm = split_wav(await chunks.__anext__())
+    except BaseException:
+        await chunks.aclose()
+        raise
+
+    async def pcm_chunks():
+        yield pcm
+        async for audio in chunks:
+            yield split_wav(audio)[1]
+
+    async def body():
+        pcm_stream = pcm_chunks()
+        encoded = encoder.encode(out_format, fmt, pcm_stream) if out_format != "wav" else None
+        try:
+            if encoded is None:
+                yield wav_header(fmt)
+                async for data in pcm_stream: yield data
+            else:
+                async for data in encoded: yield data
+        except EngineError as e:
+            # 响应头已发出，只能截断输出；这次请求的额度退还
+            logging.warning("tts stream aborted: %s", e.detail)
+            await refund_credits(api_key)
+        finally:
+            # 由外向内关闭：编码器先停掉读 PCM 的 feeder，之后各层生成器才不会处于运行中
+            if encoded is not None: await encoded.aclose()
+            await pcm_stream.aclose()
+            await chunks.aclose()
+    return StreamingResponse(body(), media_type=AUDIO_FORMATS[out_format][0], headers={"Vary": "Accept"})
+
+class _ZipSink:
+    # zipfile 的只写目标：不支持 seek/tell，zipfile 会自动改用数据描述符，写出的字节可以边生成边发送
+    def __init__(self): self._buf = bytearray()
+    def write(self, data):
+        self._buf += data
+        return len(data)
+    def flush(self): pass
+    def drain(self):
+        data = bytes(self._buf)
+        self._buf.clear()
+        return data
+
+async def iter_batch(jobs, workers):
+    # jobs: [(去重键, 转换后文本, 请求)]，按完成顺序产出 (去重键, 音频, 错误)
+    sem = asyncio.Semaphore(workers)
+    async def run(key, text, item):
+        async with sem:
+            try:
+                return key, await synthesize(text, item), None
+            except EngineError as e:
+                return key, None, e
+            except Exception as e:
+                logging.exception("batch item failed")
+                return key, None, EngineError(500, str(e))
+    tasks = [asyncio.ensure_future(run(*job)) for job in jobs]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            yield await fut
+    finally:
+        # 客户端中途断开时不再继续占用引擎和准入槽位
+        for task in tasks: task.cancel()
+
+@app.post("/tts/batch")
+async def tts_batch(batch: TTSBatchRequest, x_api_key: str = Header(...)):
+    if batch.format not in ("zip", "multipart"): raise HTTPException(status_code=400, detail="format must be zip or multipart")
+    if not batch.items: raise HTTPException(status_code=400, detail="items is empty")
+    if len(batch.items) > BATCH_MAX_ITEMS: raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+    total = len(batch.items)
+    with stage("auth"): balance = await run_in_threadpool(ledger.reserve, x_api_key, total)
+    if balance is None: raise HTTPException(status_code=401, detail="Invalid key or insufficient credits")
+
+    def plan():
+        # 相同的 (转换后文本, 音色, 参数) 只合成一次；整批转换可能要几百毫秒，放在线程池里做
+        groups, jobs = {}, []
+        for i, item in enumerate(batch.items):
+            text = convert_text(item.text, item.mode)
+            key = audio_cache_key(text, item)
+            if key not in groups:
+                groups[key] = []
+                jobs.append((key, text, item))
+            groups[key].append(i)
+        return groups, jobs
+    try:
+        groups, jobs = await run_in_threadpool(plan)
+    except BaseException:
+        await refund_credits(x_api_key, total)
+        raise
+    workers = max(1, min(BATCH_MAX_WORKERS, batch.max_workers or BATCH_MAX_WORKERS))
+
+    async def results():
+        _admission.set((x_api_key, PRIORITY_BATCH))
+        delivered = 0
+        batches = iter_batch(jobs, workers)
+        try:
+            async for key, audio, err in batches:
+                for i in groups[key]:
+                    if err is None: delivered += 1
+                    yield i, audio, err
+        finally:
+            await batches.aclose()
+            # 失败的和没来得及交付的条目都退还
+            await refund_credits(x_api_key, total - delivered)
+
+    async def zip_body():
+        sink, manifest = _ZipSink(), []
+        with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as zf:
+            async for i, audio, err in results():
+                if err is None:
+                    name = f"{i:04d}.wav"
+                    zf.writestr(name, audio)
+                    manifest.append({"index": i, "file": name})
+                else:
+                    manifest.append({"index": i, "status": err.status_code, "error": err.detail})
+                yield sink.drain()
+            manifest.sort(key=lambda m: m["index"])
+            zf.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+        yield sink.drain()
+
+    boundary = uuid.uuid4().hex
+    async def multipart_body():
+        async for i, audio, err in results():
+            if err is None:
+                head = f'Content-Type: audio/wav\r\nContent-Disposition: attachment; name="item-{i}"; filename="{i:04d}.wav"\r\nX-Item-Index: {i}'
+                payload = audio
+            else:
+                head = f'Content-Type: application/json\r\nX-Item-Index: {i}'
+                payload = json.dumps({"index": i, "status": err.status_code, "error": err.detail}, ensure_ascii=False).encode("utf-8")
+            yield f"--{boundary}\r\n{head}\r\n\r\n".encode("utf-8") + payload + b"\r\n"
+        yield f"--{boundary}--\r\n".encode("utf-8")
+
+    headers = {"X-Batch-Items": str(total), "X-Batch-Unique": str(len(jobs))}
+    if batch.format == "zip":
+        headers["Content-Disposition"] = 'attachment; filename="tts_batch.zip"'
+        return StreamingResponse(zip_body(), media_type="application/zip", headers=headers)
+    return StreamingResponse(multipart_body(), media_type=f"multipart/mixed; boundary={boundary}", headers=headers)
+
+# --- 管理接口 ---
+def require_admin(x_admin_key: str = Header(...)):
+    if x_admin_key != ADMIN_KEY: raise HTTPException(status_code=403, detail="Forbidden")
+
+@app.post("/admin/keys", dependencies=[Depends(require_admin)])
+def admin_create_key(body: KeyCreateRequest):
+    key = body.key or uuid.uuid4().hex
+    if not ledger.create_key(key, body.credits): raise HTTPException(status_code=409, detail="Key already exists")
+    return {"key": key, "credits": body.credits}
+
+@app.post("/admin/keys/{key}/credits", dependencies=[Depends(require_admin)])
+def admin_add_credits(key: str, body: CreditAdjustRequest):
+    credits = ledger.add_credits(key, body.amount)
+    if credits is None: raise HTTPException(status_code=404, detail="Key not found")
+    return {"key": key, "credits": credits}
+
+@app.delete("/admin/keys/{key}", dependencies=[Depends(require_admin)])
+def admin_delete_key(key: str):
+    if not ledger.delete_key(key): raise HTTPException(status_code=404, detail="Key not found")
+    return {"key": key, "deleted": True}
+
+@app.get("/auth/stats")
+def auth_stats():
+    return {"key_cache": key_cache.snapshot(), "ledger": ledger.snapshot()}
+
+# --- AudioQuery 查看/编辑 ---
+def require_key(x_api_key: str = Header(...)):
+    if ledger.balance(x_api_key) is None: raise HTTPException(status_code=401, detail="Invalid key")
+    return x_api_key
+
+@app.get("/audio_query")
+async def fetch_audio_query(text: str, speaker: int, mode: Optional[str] = "pseudo_jp", x_api_key: str = Depends(require_key)):
+    if not voice_catalog.has_style(speaker): raise HTTPException(status_code=400, detail=f"Unknown speaker id {speaker}")
+    target_text = await aconvert_text(text, mode)
+    entry = query_cache.get(target_text, speaker, x_api_key)
+    if entry is None:
+        # 未缓存时要调用引擎：与 /tts 一样扣一次额度并经过准入调度
+        balance = await run_in_threadpool(ledger.reserve, x_api_key)
+        if balance is None: raise HTTPException(status_code=401, detail="Invalid key or no credits")
+        try:
+            async with scheduler.slot(x_api_key, request_priority(balance)):
+                entry = await get_audio_query(target_text, speaker)
+        except BaseException:
+            await refund_credits(x_api_key)
+            raise
+    revision, q = entry
+    return {"text": target_text, "speaker": speaker, "revision": revision, "query": q}
+
+@app.put("/audio_query")
+async def edit_audio_query(body: AudioQueryEdit, x_api_key: str = Depends(require_key)):
+    # 只影响本 key 之后同文本同音色的 /tts（语速等参数仍以请求为准），其他 key 仍使用引擎原样结果
+    if not voice_catalog.has_style(body.speaker): raise HTTPException(status_code=400, detail=f"Unknown speaker id {body.speaker}")
+    target_text = await aconvert_text(body.text, body.mode)
+    revision, _ = query_cache.edit(x_api_key, target_text, body.speaker, body.query)
+    return {"text": target_text, "speaker": body.speaker, "revision": revision}
+
+@app.get("/metrics")
+def get_metrics():
+    gauges = []
+    for name, value in audio_cache.snapshot().items(): gauges.append((f"tts_audio_cache_{name}", {}, value))
+    for name, value in query_cache.snapshot().items(): gauges.append((f"tts_query_cache_{name}", {}, value))
+    for name, value in key_cache.snapshot().items(): gauges.append((f"tts_key_cache_{name}", {}, value))
+    for name, value in ledger.snapshot().items():
+        if name != "mode": gauges.append((f"tts_ledger_{name}", {}, value))
+    for name, value in voice_catalog.stats.items(): gauges.append((f"tts_voice_catalog_{name}", {}, value))
+    for name, value in encoder.stats.items(): gauges.append((f"tts_encoder_{name}", {}, value))
+    queue = scheduler.snapshot()
+    for name in ("slots", "active", "waiting", "admitted", "queued", "rejected_full", "rejected_key", "timeouts"):
+        gauges.append((f"tts_admission_{name}", {}, queue[name]))
+    for name, value in queue["waiting_by_priority"].items(): gauges.append(("tts_admission_waiting_by_priority", {"priority": name}, value))
+    for stage_name, flight in (("audio_query", query_flight), ("synthesis", synthesis_flight)):
+        for name, value in flight.snapshot().items(): gauges.append((f"tts_singleflight_{name}", {"stage": stage_name}, value))
+    memo = converter.convert_token.cache_info()
+    gauges += [("tts_converter_memo_hits", {}, memo.hits), ("tts_converter_memo_misses", {}, memo.misses),
+               ("tts_converter_memo_entries", {}, memo.currsize)]
+    for b in voicevox.snapshot():
+        labels = {"backend": b["url"]}
+        gauges += [("tts_engine_healthy", labels, int(b["healthy"])), ("tts_engine_circuit_open", labels, int(b["circuit"] == "open")),
+                   ("tts_engine_inflight", labels, b["inflight"]), ("tts_engine_queued", labels, b["queued"]),
+                   ("tts_engine_latency_seconds", labels, (b["latency_ms"] or 0) / 1000),
+                   ("tts_engine_requests", labels, b["requests"]), ("tts_engine_errors", labels, b["errors"])]
+    return Response(content=metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+@app.get("/queue")
+def queue_stats():
+    return scheduler.snapshot()
+
+@app.get("/engines")
+def engine_stats():
+    return voicevox.snapshot()
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {**audio_cache.snapshot(), "coalesced": synthesis_flight.stats["coalesced"],
+            "query_coalesced": query_flight.stats["coalesced"]}
 
 @app.get("/", response_class=HTMLResponse)
 def index():
@@ -0,0 +1,97 @@
+"""用于本地测试/压测的 VOICEVOX 桩引擎，实现 /version、/speakers、/audio_query、/synthesis。
+
+    python stub_engine.py --port 50021 --latency 0.2 --fail-rate 0.1 --audio-seconds 3
+    VOICEVOX_BASE_URL=http://127.0.0.1:50021,http://127.0.0.1:50022 python main.py
+
+返回的音频是 24kHz 单声道 16bit 的静音 WAV，长度与文本长度成正比；
+--audio-seconds 大于 0 时固定为该长度（每秒约 47KB），用于控制压测的负载大小。
+"""
+import argparse
+import asyncio
+import io
+import os
+import random
+import wave
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response
+
+STUB_LATENCY = float(os.getenv("STUB_LATENCY", "0.05"))
+STUB_FAIL_RATE = float(os.getenv("STUB_FAIL_RATE", "0"))
+STUB_AUDIO_SECONDS = float(os.getenv("STUB_AUDIO_SECONDS", "0"))
+SAMPLE_RATE = 24000
+
+SPEAKERS = [
+    {"name": "四国めたん", "speaker_uuid": "7ffcb7ce-00ec-4bdc-82cd-45a8889e43ff",
+     "styles": [{"id": 2, "name": "ノーマル"}, {"id": 0, "name": "あまあま"}]},
+    {"name": "ずんだもん", "speaker_uuid": "388f246b-8c41-4ac1-8e2d-5d79f3ff56d9",
+     "styles": [{"id": 3, "name": "ノーマル"}, {"id": 1, "name": "あまあま"}, {"id": 7, "name": "ツンツン"}]},
+]
+STYLE_IDS = {s["id"] for sp in SPEAKERS for s in sp["styles"]}
+
+app = FastAPI()
+app.state.latency, app.state.fail_rate, app.state.audio_seconds = STUB_LATENCY, STUB_FAIL_RATE, STUB_AUDIO_SECONDS
+app.state.calls = {"audio_query": 0, "synthesis": 0, "speakers": 0}
+
+
+def make_wav(frames, rate=SAMPLE_RATE):
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(b"\x00\x00" * frames)
+    return buf.getvalue()
+
+
+async def simulate(kind):
+    app.state.calls[kind] += 1
+    await asyncio.sleep(app.state.latency)
+    if random.random() < app.state.fail_rate: raise HTTPException(status_code=500, detail="stub failure")
+
+
+@app.get("/version")
+async def version():
+    return "0.0.0-stub"
+
+
+@app.get("/speakers")
+async def speakers():
+    app.state.calls["speakers"] += 1
+    return SPEAKERS
+
+
+@app.post("/audio_query")
+async def audio_query(text: str, speaker: int):
+    if speaker not in STYLE_IDS: raise HTTPException(status_code=422, detail="unknown speaker")
+    await simulate("audio_query")
+    return {"accent_phrases": [], "speedScale": 1.0, "pitchScale": 0.0, "intonationScale": 1.0, "volumeScale": 1.0,
+            "prePhonemeLength": 0.1, "postPhonemeLength": 0.1, "outputSamplingRate": SAMPLE_RATE,
+            "outputStereo": False, "kana": text}
+
+
+@app.post("/synthesis")
+async def synthesis(speaker: int, request: Request):
+    query = await request.json()
+    await simulate("synthesis")
+    # 约每字 0.1 秒音频，语速越快越短
+    seconds = app.state.audio_seconds or 0.2 + 0.1 * len(query.get("kana", "")) / max(query.get("speedScale", 1.0), 0.1)
+    rate = int(query.get("outputSamplingRate", SAMPLE_RATE))
+    return Response(content=make_wav(int(seconds * rate), rate), media_type="audio/wav")
+
+
+@app.get("/stub/calls")
+async def calls():
+    return app.state.calls
+
+
+if __name__ == "__main__":
+    import uvicorn
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=50021)
+    parser.add_argument("--latency", type=float, default=STUB_LATENCY)
+    parser.add_argument("--fail-rate", type=float, default=STUB_FAIL_RATE)
+    parser.add_argument("--audio-seconds", type=float, default=STUB_AUDIO_SECONDS)
+    args = parser.parse_args()
+    app.state.latency, app.state.fail_rate, app.state.audio_seconds = args.latency, args.fail_rate, args.audio_seconds
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,47 @@
+import os
+import sys
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# main 在导入时会在当前目录建库和缓存目录，先切到临时目录
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="tts_tests_"))
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'ledger.db'}", connect_args={"check_same_thread": False})
+    main.Base.metadata.create_all(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def make_ledger(session_factory, tmp_path):
+    # 同一个 tmp_path 下多次调用相当于进程重启：共用数据库与 journal
+    ledgers = []
+
+    def factory(flush_interval=1.0, ttl=30, factory=None):
+        ledger = main.CreditLedger(factory or session_factory, str(tmp_path / "credit_journal.log"), flush_interval,
+                                   main.KeyCache(ttl, ttl, 1000))
+        ledger.recover()
+        ledgers.append(ledger)
+        return ledger
+    yield factory
+    for ledger in ledgers:
+        if ledger._journal is not None: ledger._journal.close()
+
+
+def db_credits(session_factory, key):
+    db = session_factory()
+    try:
+        record = db.get(main.APIKeyRecord, key)
+        return record.credits if record else None
+    finally:
+        db.close()
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def make_scheduler(slots=1, max_queue=10, per_key_queue=10, deadline=5):
+    return main.AdmissionScheduler(slots, max_queue, per_key_queue, (deadline, deadline, deadline))
+
+
+async def hold(scheduler, key="holder", priority=main.PRIORITY_NORMAL):
+    # 手动进入槽位，返回的上下文由调用方退出
+    cm = scheduler.slot(key, priority)
+    await cm.__aenter__()
+    return cm
+
+
+async def enqueue(scheduler, requests, order):
+    async def one(key, priority):
+        async with scheduler.slot(key, priority): order.append(key)
+    tasks = []
+    for key, priority in requests:
+        tasks.append(asyncio.ensure_future(one(key, priority)))
+        await asyncio.sleep(0)  # 保证按列表顺序入队
+    return tasks
+
+
+def test_queue_serves_priority_tiers_then_rotates_keys():
+    scheduler, order = make_scheduler(), []
+
+    async def run():
+        holder = await hold(scheduler)
+        tasks = await enqueue(scheduler, [("batch", main.PRIORITY_BATCH), ("a", main.PRIORITY_NORMAL),
+                                          ("a", main.PRIORITY_NORMAL), ("a", main.PRIORITY_NORMAL),
+                                          ("b", main.PRIORITY_NORMAL), ("rich", main.PRIORITY_HIGH)], order)
+        assert scheduler.snapshot()["waiting_by_priority"] == {"high": 1, "normal": 4, "batch": 1}
+        await holder.__aexit__(None, None, None)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == ["rich", "a", "b", "a", "a", "batch"]
+    assert (scheduler.active, scheduler.waiting) == (0, 0)
+
+
+def test_cancel_while_queued_leaves_the_queue():
+    scheduler, order = make_scheduler(), []
+
+    async def run():
+        holder = await hold(scheduler)
+        cancelled, kept = await enqueue(scheduler, [("a", main.PRIORITY_NORMAL), ("b", main.PRIORITY_NORMAL)], order)
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError): await cancelled
+        assert (scheduler.waiting, scheduler._per_key) == (1, {"b": 1})
+        await holder.__aexit__(None, None, None)
+        await kept
+
+    asyncio.run(run())
+    assert order == ["b"]
+    assert (scheduler.active, scheduler.waiting) == (0, 0)
+
+
+def test_cancel_after_grant_hands_the_slot_back():
+    scheduler, order = make_scheduler(), []
+
+    async def run():
+        holder = await hold(scheduler)
+        waiter, = await enqueue(scheduler, [("a", main.PRIORITY_NORMAL)], order)
+        await holder.__aexit__(None, None, None)  # 槽位已转给 a，但 a 还没来得及运行
+        assert (scheduler.active, scheduler.waiting) == (1, 0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError): await waiter
+        assert scheduler.active == 0
+        async with scheduler.slot("b", main.PRIORITY_NORMAL): order.append("b")
+
+    asyncio.run(run())
+    assert order == ["b"]
+    assert scheduler.stats["queued"] == 1
+
+
+def test_deadline_rejects_with_503_and_dequeues():
+    scheduler = make_scheduler(deadline=0.02)
+
+    async def run():
+        holder = await hold(scheduler)
+        with pytest.raises(main.AdmissionRejected) as e:
+            async with scheduler.slot("a", main.PRIORITY_NORMAL): pass
+        assert (scheduler.waiting, scheduler._per_key) == (0, {})
+        await holder.__aexit__(None, None, None)
+        return e.value
+
+    rejected = asyncio.run(run())
+    assert (rejected.status_code, rejected.key) == (503, None)
+    assert rejected.retry_after >= 1
+    assert scheduler.stats["timeouts"] == 1
+    assert scheduler.active == 0
+
+
+def test_per_key_limit_and_full_queue():
+    scheduler, order = make_scheduler(max_queue=2, per_key_queue=1), []
+
+    async def run():
+        holder = await hold(scheduler)
+        tasks = await enqueue(scheduler, [("a", main.PRIORITY_NORMAL)], order)
+        with pytest.raises(main.AdmissionRejected) as per_key:
+            async with scheduler.slot("a", main.PRIORITY_NORMAL): pass
+        tasks += await enqueue(scheduler, [("b", main.PRIORITY_NORMAL)], order)
+        with pytest.raises(main.AdmissionRejected) as full:
+            async with scheduler.slot("c", main.PRIORITY_HIGH): pass
+        await holder.__aexit__(None, None, None)
+        await asyncio.gather(*tasks)
+        return per_key.value, full.value
+
+    per_key, full = asyncio.run(run())
+    assert (per_key.status_code, per_key.key) == (429, "a")
+    assert (full.status_code, full.key) == (503, None)
+    assert order == ["a", "b"]
+    assert (scheduler.stats["rejected_key"], scheduler.stats["rejected_full"]) == (1, 1)
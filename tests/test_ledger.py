@@ -0,0 +1,119 @@
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import main
+from conftest import db_credits
+
+
+@pytest.mark.parametrize("flush_interval", [1.0, 0])
+def test_reserve_is_a_conditional_decrement(make_ledger, flush_interval):
+    ledger = make_ledger(flush_interval)
+    ledger.create_key("k", 2)
+    assert ledger.reserve("k") == 1
+    assert ledger.reserve("k") == 0
+    assert ledger.reserve("k") is None
+    assert ledger.balance("k") == 0
+    ledger.refund("k")
+    assert ledger.balance("k") == 1
+    assert ledger.reserve("k", 2) is None
+    assert ledger.reserve("missing") is None
+
+
+@pytest.mark.parametrize("flush_interval", [1.0, 0])
+def test_concurrent_reserves_never_overdraw(make_ledger, session_factory, flush_interval):
+    ledger = make_ledger(flush_interval)
+    ledger.create_key("k", 20)
+    with ThreadPoolExecutor(16) as pool:
+        results = list(pool.map(lambda _: ledger.reserve("k"), range(100)))
+    assert sum(b is not None for b in results) == 20
+    ledger.flush()
+    assert db_credits(session_factory, "k") == 0
+
+
+def test_flush_writes_pending_deltas_once(make_ledger, session_factory, tmp_path):
+    ledger = make_ledger()
+    ledger.create_key("k", 10)
+    for _ in range(3): ledger.reserve("k")
+    ledger.refund("k")
+    assert db_credits(session_factory, "k") == 10
+    ledger.flush()
+    assert db_credits(session_factory, "k") == 8
+    assert (tmp_path / "credit_journal.log").read_text() == ""
+    ledger.flush()
+    assert db_credits(session_factory, "k") == 8
+    assert ledger.balance("k") == 8
+
+
+def test_failed_reread_after_commit_does_not_charge_twice(make_ledger, session_factory, monkeypatch):
+    ledger = make_ledger()
+    ledger.create_key("k", 10)
+    ledger.reserve("k", 4)
+
+    class FailingQuery:
+        def __init__(self, session): self.session = session
+        def __getattr__(self, name): return getattr(self.session, name)
+        def query(self, *args, **kwargs): raise RuntimeError("read failed")
+
+    ledger.session_factory = lambda: FailingQuery(session_factory())
+    ledger.flush()
+    ledger.session_factory = session_factory
+    ledger.flush()
+    assert db_credits(session_factory, "k") == 6
+    assert ledger.balance("k") == 6
+    assert ledger.snapshot()["flush_errors"] == 0
+
+
+def test_crash_replay_is_idempotent(make_ledger, session_factory, tmp_path):
+    ledger = make_ledger()
+    ledger.create_key("k", 10)
+    for _ in range(3): ledger.reserve("k")
+    # 进程崩溃：没有 flush，只留下 journal
+    ledger._journal.close()
+    ledger._journal = None
+    make_ledger()
+    assert db_credits(session_factory, "k") == 7
+    make_ledger()
+    assert db_credits(session_factory, "k") == 7
+
+
+def test_replay_skips_entries_already_flushed(make_ledger, session_factory, tmp_path):
+    ledger = make_ledger()
+    ledger.create_key("k", 10)
+    for _ in range(3): ledger.reserve("k")
+    journal = tmp_path / "credit_journal.log"
+    # 崩溃发生在提交之后、journal 重写之前：旧 journal 里的条目已经落库
+    shutil.copy(journal, tmp_path / "journal.bak")
+    ledger.flush()
+    ledger._journal.close()
+    ledger._journal = None
+    shutil.copy(tmp_path / "journal.bak", journal)
+    make_ledger()
+    assert db_credits(session_factory, "k") == 7
+
+
+@pytest.mark.parametrize("flush_interval", [1.0, 0])
+def test_reserve_works_with_key_cache_disabled(make_ledger, session_factory, flush_interval):
+    ledger = make_ledger(flush_interval, ttl=0)
+    ledger.create_key("k", 5)
+    assert [ledger.reserve("k") for _ in range(5)] == [4, 3, 2, 1, 0]
+    assert ledger.reserve("k") is None
+    assert ledger.reserve("missing") is None
+    ledger.refund("k", 2)
+    assert ledger.balance("k") == 2
+    ledger.flush()
+    assert db_credits(session_factory, "k") == 2
+
+
+def test_flush_picks_up_external_credit_changes(make_ledger, session_factory):
+    ledger = make_ledger()
+    ledger.create_key("k", 10)
+    ledger.reserve("k")
+    db = session_factory()
+    db.get(main.APIKeyRecord, "k").credits = 100
+    db.commit()
+    db.close()
+    ledger.flush()
+    assert ledger.balance("k") == 99
+    assert ledger.reserve("k", 99) == 0
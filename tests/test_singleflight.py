@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def test_callers_share_one_call():
+    flight, calls = main.SingleFlight(), []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "audio"
+
+    async def run():
+        return await asyncio.gather(*[flight.do("k", fetch) for _ in range(5)])
+
+    assert asyncio.run(run()) == ["audio"] * 5
+    assert calls == [1]
+    assert flight.snapshot() == {"leaders": 1, "coalesced": 4, "inflight": 0}
+
+
+def test_cancelled_caller_does_not_cancel_the_others():
+    flight = main.SingleFlight()
+
+    async def run():
+        gate = asyncio.Event()
+
+        async def fetch():
+            await gate.wait()
+            return "audio"
+
+        leader = asyncio.ensure_future(flight.do("k", fetch))
+        follower = asyncio.ensure_future(flight.do("k", fetch))
+        await asyncio.sleep(0)
+        leader.cancel()  # 领头的客户端断开
+        await asyncio.sleep(0)
+        gate.set()
+        with pytest.raises(asyncio.CancelledError): await leader
+        return await follower
+
+    assert asyncio.run(run()) == "audio"
+    assert flight.snapshot()["inflight"] == 0
+
+
+def test_error_reaches_every_caller_and_frees_the_key():
+    flight, calls = main.SingleFlight(), []
+
+    async def fail():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise main.EngineError(502, "engine down")
+
+    async def ok():
+        return "audio"
+
+    async def run():
+        results = await asyncio.gather(flight.do("k", fail), flight.do("k", fail), return_exceptions=True)
+        return results, await flight.do("k", ok)
+
+    results, retried = asyncio.run(run())
+    assert [r.status_code for r in results] == [502, 502]
+    assert calls == [1]
+    assert retried == "audio"
+
+
+def test_follower_retries_when_leader_key_is_rejected(monkeypatch):
+    # 同一文本：ka 排队已达上限被 429，合并到 ka 上的 kb 应该用自己的 key 重新排队并成功
+    gate = asyncio.Event()
+    monkeypatch.setattr(main, "scheduler", main.AdmissionScheduler(1, 10, 1, (5, 5, 5)))
+
+    async def audio_query(text, speaker):
+        return {"text": text}
+
+    async def synthesis(query, speaker):
+        await gate.wait()
+        return f"audio:{query['text']}".encode()
+
+    monkeypatch.setattr(main.voicevox, "audio_query", audio_query)
+    monkeypatch.setattr(main.voicevox, "synthesis", synthesis)
+
+    async def as_key(key, text):
+        main._admission.set((key, main.PRIORITY_NORMAL))
+        try:
+            return await main.synthesize(text, main.TTSRequest(text=text, speaker=3))
+        except main.AdmissionRejected as e:
+            return e.status_code
+
+    async def run():
+        # ka 一个请求占着槽位、一个在排队，已到单 key 排队上限
+        busy = [asyncio.ensure_future(as_key("ka", t)) for t in ("follower-甲", "follower-乙")]
+        await asyncio.sleep(0.01)
+        shared = asyncio.gather(as_key("ka", "follower-共享"), as_key("kb", "follower-共享"))
+        await asyncio.sleep(0.01)
+        gate.set()
+        return await shared, await asyncio.gather(*busy)
+
+    shared, busy = asyncio.run(run())
+    assert shared == [429, "audio:follower-共享".encode()]
+    assert busy == [f"audio:follower-{t}".encode() for t in ("甲", "乙")]
@@ -0,0 +1,52 @@
+import asyncio
+import io
+import wave
+
+import main
+
+
+def make_wav(frames, rate=24000):
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(b"\x01\x00" * frames)
+    return buf.getvalue()
+
+
+def test_client_disconnect_during_encoded_stream(tmp_path, monkeypatch):
+    # 透传 "编码器"：把 PCM 原样输出，保证第一块数据能马上读到
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text("#!/bin/sh\nexec cat\n")
+    ffmpeg.chmod(0o755)
+    monkeypatch.setattr(main.encoder, "ffmpeg_bin", str(ffmpeg))
+    started, cancelled, refunds = [], [], []
+
+    async def slow_synthesize(text, req):
+        # 首句立即返回，后续句子模拟很慢的引擎
+        started.append(text)
+        try:
+            if len(started) > 1: await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(text)
+            raise
+        return make_wav(2400)
+
+    async def fake_refund(key, amount=1): refunds.append((key, amount))
+    monkeypatch.setattr(main, "synthesize", slow_synthesize)
+    monkeypatch.setattr(main, "refund_credits", fake_refund)
+
+    async def run():
+        req = main.TTSRequest(text="-", speaker=3, stream=True, format="mp3")
+        resp = await main.stream_tts("一。二。三。四。", req, "mp3", "k")
+        body = resp.body_iterator
+        first = await body.__anext__()
+        await body.aclose()  # 客户端断开
+        await asyncio.sleep(0.05)
+        return first
+
+    assert asyncio.run(run())
+    assert len(started) > 1
+    assert sorted(cancelled) == sorted(started[1:])
+    assert refunds == []